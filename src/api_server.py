@@ -1,5 +1,6 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 import uvicorn
@@ -8,25 +9,37 @@ import threading
 from concurrent.futures import ThreadPoolExecutor
 import sys
 import os
+import json
 
 # Add the src directory to the path so we can import our modules
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from credit_risk_formatter import format_credit_risk_input
-from load_qlora_model import load_qlora_model, ask_financial_risk_qlora
-from load_lora_model import load_lora_model, ask_financial_risk_lora
+from credit_risk_formatter import format_credit_risk_input, build_prompt
+from load_qlora_model import load_qlora_model, ask_financial_risk_qlora, GENERATION_CONFIG as QLORA_GENERATION_CONFIG
+from load_lora_model import load_lora_model, ask_financial_risk_lora, GENERATION_CONFIG as LORA_GENERATION_CONFIG
+from load_base_model import load_base_model, MODEL_PATH as BASE_MODEL_PATH, GENERATION_CONFIG as BASE_GENERATION_CONFIG
 
 # Global variables to store loaded models
 qlora_model = None
 lora_model = None
+base_model = None
+
+# A Llama instance runs one generation at a time; every request (API or UI) queues on the model's lock
+model_locks = {
+    "qlora": threading.Lock(),
+    "lora": threading.Lock(),
+    "base": threading.Lock(),
+}
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Load models on startup and cleanup on shutdown"""
-    global qlora_model, lora_model
+    global qlora_model, lora_model, base_model
     print("Loading models...")
     qlora_model = load_qlora_model()
     lora_model = load_lora_model()
+    if os.path.exists(BASE_MODEL_PATH):
+        base_model = load_base_model()
     print("Models loaded successfully!")
     yield
     print("Shutting down...")
@@ -86,7 +99,8 @@ def run_qlora_inference(request_data: CreditRiskRequest) -> ModelResponse:
     )
     
     # Get model response
-    response = ask_financial_risk_qlora(formatted_input, qlora_model)
+    with model_locks["qlora"]:
+        response = ask_financial_risk_qlora(formatted_input, qlora_model)
     
     processing_time = time.time() - start_time
     
@@ -114,7 +128,8 @@ def run_lora_inference(request_data: CreditRiskRequest) -> ModelResponse:
     )
     
     # Get model response
-    response = ask_financial_risk_lora(formatted_input, lora_model)
+    with model_locks["lora"]:
+        response = ask_financial_risk_lora(formatted_input, lora_model)
     
     processing_time = time.time() - start_time
     
@@ -125,6 +140,40 @@ def run_lora_inference(request_data: CreditRiskRequest) -> ModelResponse:
         processing_time=processing_time
     )
 
+def get_streaming_model(model_name: str):
+    """Return (llm, generation_config) for a model name, llm is None if it is not loaded"""
+    models = {
+        "qlora": (qlora_model, QLORA_GENERATION_CONFIG),
+        "lora": (lora_model, LORA_GENERATION_CONFIG),
+        "base": (base_model, BASE_GENERATION_CONFIG),
+    }
+    return models.get(model_name, (None, None))
+
+def stream_inference(model_name: str, request_data: CreditRiskRequest):
+    """
+    Yield the model's output as newline-delimited JSON {"text": ...} chunks.
+    The model's lock is held for the whole generation (a Llama instance cannot
+    interleave two) and released as soon as the generator is closed, including
+    when the client disconnects mid-stream.
+    """
+    llm, generation_config = get_streaming_model(model_name)
+    formatted_input = format_credit_risk_input(
+        age=request_data.age,
+        occupation=request_data.occupation,
+        annual_income=request_data.annual_income,
+        credit_utilization=request_data.credit_utilization,
+        outstanding_debt=request_data.outstanding_debt,
+        payment_behavior=request_data.payment_behavior,
+        credit_mix="Standard"
+    )
+    with model_locks[model_name]:
+        stream = llm.create_completion(build_prompt(formatted_input), stream=True, **generation_config)
+        try:
+            for chunk in stream:
+                yield json.dumps({"text": chunk["choices"][0]["text"]}) + "\n"
+        finally:
+            stream.close()
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -135,6 +184,7 @@ async def root():
             "qlora": "/inference/qlora",
             "lora": "/inference/lora", 
             "parallel": "/inference/parallel",
+            "stream": "/inference/{qlora|lora|base}/stream",
             "health": "/health"
         }
     }
@@ -144,11 +194,18 @@ async def health_check():
     """Health check endpoint"""
     return {
         "status": "healthy",
-        "models_loaded": qlora_model is not None and lora_model is not None
+        "models_loaded": qlora_model is not None and lora_model is not None,
+        "models": {
+            "qlora": qlora_model is not None,
+            "lora": lora_model is not None,
+            "base": base_model is not None
+        }
     }
 
+# Blocking inference handlers are plain functions so FastAPI runs them in its threadpool
+# instead of waiting on a model lock on the event loop
 @app.post("/inference/qlora", response_model=ModelResponse)
-async def qlora_inference(request: CreditRiskRequest):
+def qlora_inference(request: CreditRiskRequest):
     """Run QLoRA model inference"""
     if qlora_model is None:
         raise HTTPException(status_code=500, detail="QLoRA model not loaded")
@@ -160,7 +217,7 @@ async def qlora_inference(request: CreditRiskRequest):
         raise HTTPException(status_code=500, detail=f"QLoRA inference failed: {str(e)}")
 
 @app.post("/inference/lora", response_model=ModelResponse)
-async def lora_inference(request: CreditRiskRequest):
+def lora_inference(request: CreditRiskRequest):
     """Run LoRA model inference"""
     if lora_model is None:
         raise HTTPException(status_code=500, detail="LoRA model not loaded")
@@ -172,7 +229,7 @@ async def lora_inference(request: CreditRiskRequest):
         raise HTTPException(status_code=500, detail=f"LoRA inference failed: {str(e)}")
 
 @app.post("/inference/parallel", response_model=ParallelResponse)
-async def parallel_inference(request: CreditRiskRequest):
+def parallel_inference(request: CreditRiskRequest):
     """Run both models in parallel"""
     if qlora_model is None or lora_model is None:
         raise HTTPException(status_code=500, detail="Models not loaded")
@@ -202,6 +259,48 @@ async def parallel_inference(request: CreditRiskRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Parallel inference failed: {str(e)}")
 
+@app.post("/inference/{model_name}/stream")
+async def streaming_inference(model_name: str, request: CreditRiskRequest):
+    """Stream a model's output token by token as newline-delimited JSON"""
+    llm, _ = get_streaming_model(model_name)
+    if llm is None:
+        raise HTTPException(status_code=404, detail=f"Model '{model_name}' not loaded")
+
+    loop = asyncio.get_running_loop()
+    chunks_queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def produce():
+        # The generator is advanced and closed on this one thread: closing it releases the model's lock,
+        # and a generator cannot be closed from another thread while it is running
+        chunks = stream_inference(model_name, request)
+        try:
+            for chunk in chunks:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(chunks_queue.put_nowait, chunk)
+        except Exception as e:
+            loop.call_soon_threadsafe(chunks_queue.put_nowait, e)
+        finally:
+            chunks.close()
+            loop.call_soon_threadsafe(chunks_queue.put_nowait, None)
+
+    async def body():
+        threading.Thread(target=produce, daemon=True).start()
+        try:
+            while True:
+                chunk = await chunks_queue.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            # Set when the client disconnects: the producer stops after the token it is generating
+            stop.set()
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
 if __name__ == "__main__":
     uvicorn.run(
         "api_server:app",
@@ -1,14 +1,32 @@
 import streamlit as st
+import json
+import queue
 import sys
 import os
+import threading
+import urllib.request
 
 # Add the src directory to the path so we can import our modules
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from credit_risk_formatter import format_credit_risk_input
-from load_qlora_model import load_qlora_model, ask_financial_risk_qlora
-from load_lora_model import load_lora_model, ask_financial_risk_lora
-from load_base_model import load_base_model, ask_financial_risk_base
+from credit_risk_formatter import format_credit_risk_input, build_prompt
+from load_qlora_model import load_qlora_model, GENERATION_CONFIG as QLORA_GENERATION_CONFIG
+from load_lora_model import load_lora_model, GENERATION_CONFIG as LORA_GENERATION_CONFIG
+from load_base_model import load_base_model, MODEL_PATH as BASE_MODEL_PATH, GENERATION_CONFIG as BASE_GENERATION_CONFIG
+from prediction_store import PredictionStore
+from stream_renderer import StreamRenderer
+
+# Evaluation results written by evaluate.py
+EVAL_STORE_PATH = os.environ.get(
+    "CREDIT_RISK_EVAL_STORE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "eval_results", "predictions.db"),
+)
+
+# Base URL of a running api_server.py (e.g. http://localhost:8000); models are loaded in-process when unset
+API_URL = os.environ.get("CREDIT_RISK_API_URL", "").rstrip("/")
+
+# Redraws per second of each streaming model output
+STREAM_FPS = 15
 
 # Page configuration
 st.set_page_config(
@@ -133,19 +151,131 @@ st.markdown("""
 
 
 
+@st.cache_resource
+def get_model_locks():
+    """One lock per model: a Llama instance is shared by every session but can only run one generation at a time"""
+    return {model_name: threading.Lock() for model_name in ("QLoRA", "LoRA", "Base")}
+
+
+def iter_local_chunks(llm, lock, generation_config, formatted_input):
+    """Stream text chunks from an in-process Llama instance"""
+    with lock:
+        for chunk in llm.create_completion(build_prompt(formatted_input), stream=True, **generation_config):
+            yield chunk["choices"][0]["text"]
+
+
+def iter_api_chunks(api_url, model_name, features):
+    """Stream text chunks from the API server's newline-delimited JSON streaming endpoint"""
+    request = urllib.request.Request(
+        f"{api_url}/inference/{model_name.lower()}/stream",
+        data=json.dumps(features).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            if line.strip():
+                yield json.loads(line)["text"]
+
+
+def get_api_models(api_url):
+    """
+    Return {model_name: loaded} from the API server's health endpoint, or None
+    when no server is configured or it cannot be reached
+    """
+    if not api_url:
+        return None
+    try:
+        with urllib.request.urlopen(f"{api_url}/health", timeout=2) as response:
+            return json.loads(response.read())["models"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def stream_model_output(model_name, chunks, events):
+    """
+    Worker thread body: consume one model's chunk iterator and push (model_name, text)
+    events for every chunk, an exception if generation fails, then (model_name, None)
+    """
+    try:
+        for text in chunks:
+            events.put((model_name, text))
+    except Exception as e:
+        events.put((model_name, e))
+    finally:
+        events.put((model_name, None))
+
+
 @st.cache_resource
 def load_models():
     """Load all models and cache them. If base model file is missing, return None for base_model."""
     qlora_model = load_qlora_model()
     lora_model = load_lora_model()
-    base_model_path = r"D:\Narwal\fine-tuning-lora-qlora\qwen2.5-3b-instruct-q8_0.gguf"
-    if os.path.exists(base_model_path):
+    if os.path.exists(BASE_MODEL_PATH):
         base_model = load_base_model()
     else:
         base_model = None
     return qlora_model, lora_model, base_model
 
 
+@st.cache_data(show_spinner=False)
+def load_accuracy_summary(store_path, store_mtime):
+    """
+    Read per-model accuracy from the evaluation store. store_mtime is only part
+    of the cache key, so the store is re-read exactly when evaluate.py writes to it.
+    """
+    if store_mtime is None:
+        return {}
+    store = PredictionStore(store_path, read_only=True)
+    try:
+        return store.summarize()
+    finally:
+        store.close()
+
+
+@st.fragment(run_every=60)
+def render_model_performance():
+    """Accuracy cards, re-checked in the background once a minute without rerunning the page"""
+    store_mtime = os.path.getmtime(EVAL_STORE_PATH) if os.path.exists(EVAL_STORE_PATH) else None
+    summary = load_accuracy_summary(EVAL_STORE_PATH, store_mtime)
+
+    largest_eval = max((stats["total"] for stats in summary.values()), default=0)
+    st.markdown(
+        f'<h2 class="section-header">📊 Model Performance ({largest_eval:,} Sample Evaluation)</h2>',
+        unsafe_allow_html=True
+    )
+
+    base_stats = summary.get("base")
+    cards = [
+        ("base", "Base Model", "linear-gradient(135deg, #764ba2 0%, #667eea 100%)"),
+        ("lora", "LoRA Model", "linear-gradient(135deg, #ff6b35 0%, #f7931e 100%)"),
+        ("qlora", "QLoRA Model", "linear-gradient(135deg, #1e3c72 0%, #2a5298 100%)"),
+    ]
+    for column, (model_name, title, background) in zip(st.columns(3), cards):
+        stats = summary.get(model_name)
+        if stats is None:
+            accuracy = "—"
+            caption = "No evaluation results yet"
+        else:
+            low, high = stats["accuracy_ci"]
+            accuracy = f"{stats['accuracy'] * 100:.1f}%"
+            caption = f"95% CI {low * 100:.1f}–{high * 100:.1f}% · n = {stats['total']:,}"
+            if model_name == "base":
+                caption = f"Baseline Performance<br>{caption}"
+            elif base_stats is not None:
+                delta = (stats["accuracy"] - base_stats["accuracy"]) * 100
+                caption = f"{delta:+.1f}% vs. Base<br>{caption}"
+
+        with column:
+            st.markdown(f"""
+            <div style="background: {background}; 
+                        padding: 1.5rem; border-radius: 15px; text-align: center; color: white;">
+                <h3 style="margin: 0; font-size: 1.2rem;">{title}</h3>
+                <div style="font-size: 2.5rem; font-weight: bold; margin: 0.5rem 0;">{accuracy}</div>
+                <div style="font-size: 0.9rem; opacity: 0.9;">{caption}</div>
+            </div>
+            """, unsafe_allow_html=True)
+
+
 def main():
     # Header
     st.markdown('<h1 class="main-header">🏦 Credit Risk Assessment Tool</h1>', unsafe_allow_html=True)
@@ -192,40 +322,7 @@ def main():
     st.markdown('</div>', unsafe_allow_html=True)
 
     # Model Performance Section
-    st.markdown('<h2 class="section-header">📊 Model Performance (10 Sample Evaluation)</h2>', unsafe_allow_html=True)
-    
-    # Create columns for accuracy display
-    acc_col1, acc_col2, acc_col3 = st.columns(3)
-    
-    with acc_col1:
-        st.markdown("""
-        <div style="background: linear-gradient(135deg, #764ba2 0%, #667eea 100%); 
-                    padding: 1.5rem; border-radius: 15px; text-align: center; color: white;">
-            <h3 style="margin: 0; font-size: 1.2rem;">Base Model</h3>
-            <div style="font-size: 2.5rem; font-weight: bold; margin: 0.5rem 0;">20%</div>
-            <div style="font-size: 0.9rem; opacity: 0.9;">Baseline Performance</div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with acc_col2:
-        st.markdown("""
-        <div style="background: linear-gradient(135deg, #ff6b35 0%, #f7931e 100%); 
-                    padding: 1.5rem; border-radius: 15px; text-align: center; color: white;">
-            <h3 style="margin: 0; font-size: 1.2rem;">LoRA Model</h3>
-            <div style="font-size: 2.5rem; font-weight: bold; margin: 0.5rem 0;">60%</div>
-            <div style="font-size: 0.9rem; opacity: 0.9;">+40% Improvement</div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with acc_col3:
-        st.markdown("""
-        <div style="background: linear-gradient(135deg, #1e3c72 0%, #2a5298 100%); 
-                    padding: 1.5rem; border-radius: 15px; text-align: center; color: white;">
-            <h3 style="margin: 0; font-size: 1.2rem;">QLoRA Model</h3>
-            <div style="font-size: 2.5rem; font-weight: bold; margin: 0.5rem 0;">50%</div>
-            <div style="font-size: 0.9rem; opacity: 0.9;">+30% Improvement</div>
-        </div>
-        """, unsafe_allow_html=True)
+    render_model_performance()
 
     # Model selection
     st.markdown('<h2 class="section-header">🤖 Select Models to Compare</h2>', unsafe_allow_html=True)
@@ -268,35 +365,84 @@ def main():
             credit_mix="Standard"
         )
 
-        with st.spinner(f"Loading models: {', '.join(selected_models)}..."):
-            qlora_model, lora_model, base_model = load_models()
-
-        # Run all selected models
+        # Prefer the shared API server so the UI and API traffic use one set of weights;
+        # load the models in-process only when no server is configured or reachable
+        api_models = get_api_models(API_URL)
+        if API_URL and api_models is None:
+            st.warning(f"⚠️ API server at {API_URL} is unreachable, running models in-process.")
+
+        chunk_streams = {}
+        if api_models is not None:
+            features = {
+                "age": int(age),
+                "occupation": occupation,
+                "annual_income": float(annual_income),
+                "outstanding_debt": float(outstanding_debt),
+                "credit_utilization": float(credit_utilization),
+                "payment_behavior": payment_behavior,
+            }
+            for model_name in selected_models:
+                if api_models.get(model_name.lower()):
+                    chunk_streams[model_name] = iter_api_chunks(API_URL, model_name, features)
+        else:
+            with st.spinner(f"Loading models: {', '.join(selected_models)}..."):
+                qlora_model, lora_model, base_model = load_models()
+            local_models = {
+                "QLoRA": (qlora_model, QLORA_GENERATION_CONFIG),
+                "LoRA": (lora_model, LORA_GENERATION_CONFIG),
+                "Base": (base_model, BASE_GENERATION_CONFIG),
+            }
+            locks = get_model_locks()
+            for model_name in selected_models:
+                llm, generation_config = local_models[model_name]
+                if llm is not None:
+                    chunk_streams[model_name] = iter_local_chunks(llm, locks[model_name], generation_config, formatted_input)
+
+        # Lay out one container per selected model before any generation starts
+        container_classes = {"QLoRA": "qlora-container", "LoRA": "lora-container", "Base": "base-container"}
+        containers = {}
         for model_name in selected_models:
-            # Dynamic container background
-            if model_name == "QLoRA":
-                container_class = "qlora-container"
-            elif model_name == "LoRA":
-                container_class = "lora-container"
-            else:
-                container_class = "base-container"
-
-            st.markdown(f'<div class="{container_class}">', unsafe_allow_html=True)
+            st.markdown(f'<div class="{container_classes[model_name]}">', unsafe_allow_html=True)
             st.markdown(f'<div class="model-title">{model_name} Model</div>', unsafe_allow_html=True)
             container = st.empty()
             container.markdown(f'<div class="streaming-text">Starting {model_name} model...</div>', unsafe_allow_html=True)
             st.markdown('</div>', unsafe_allow_html=True)
+            containers[model_name] = container
 
-            # Run the selected model
-            if model_name == "QLoRA":
-                result = ask_financial_risk_qlora(formatted_input, qlora_model, container)
-            elif model_name == "LoRA":
-                result = ask_financial_risk_lora(formatted_input, lora_model, container)
-            elif model_name == "Base":
-                if base_model:
-                    result = ask_financial_risk_base(formatted_input, base_model, container)
-                else:
-                    container.markdown('<div class="streaming-text">Base model file not found.</div>', unsafe_allow_html=True)
+        # Run all selected models at once, one worker thread per model.
+        # Workers only push text onto the queue; every Streamlit call stays on this script thread.
+        events = queue.Queue()
+        workers = []
+        for model_name in selected_models:
+            if model_name not in chunk_streams:
+                containers[model_name].markdown(f'<div class="streaming-text">{model_name} model file not found.</div>', unsafe_allow_html=True)
+                continue
+            worker = threading.Thread(
+                target=stream_model_output,
+                args=(model_name, chunk_streams[model_name], events),
+                daemon=True,
+            )
+            worker.start()
+            workers.append(worker)
+
+        renderers = {model_name: StreamRenderer(containers[model_name], fps=STREAM_FPS) for model_name in selected_models}
+        running = len(workers)
+        while running:
+            try:
+                model_name, text = events.get(timeout=1 / STREAM_FPS)
+            except queue.Empty:
+                # No new tokens this frame: draw whatever is still buffered
+                for renderer in renderers.values():
+                    renderer.flush()
+                continue
+            if text is None:
+                renderers[model_name].flush()
+                running -= 1
+                continue
+            if isinstance(text, Exception):
+                containers[model_name].error(f"{model_name} generation failed: {text}")
+                continue
+            renderers[model_name].write(text)
 
         with st.expander("📋 Raw Input Data"):
             st.json({
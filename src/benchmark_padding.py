@@ -0,0 +1,113 @@
+import argparse
+import os
+import sys
+
+import torch
+from torch.utils import benchmark
+
+# The compiled GRPO trainer lives next to src/, outside any package
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "unsloth_compiled_cache"))
+
+from UnslothGRPOTrainer import (
+    calculate_pad_tokens_in_prompt,
+    create_completion_attention_mask,
+    left_pack_padding,
+    left_pack_padding_with_completion_mask,
+)
+
+PAD_TOKEN_ID = 0
+
+# (batch, prompt length, completion length) around what GRPO sees per loss call
+SHAPES = [
+    (6, 256, 768),
+    (16, 256, 768),
+    (16, 512, 1536),
+    (32, 512, 3584),
+    (64, 1024, 3072),
+]
+
+
+def make_batch(batch_size: int, prompt_length: int, completion_length: int, device: str, seed: int = 0) -> torch.Tensor:
+    """Left padded prompts followed by right padded completions, as GRPO builds prompt_completion_ids"""
+    # Drawn on the CPU from a seeded generator, so every run and device times the same batch
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(1, 32000, (batch_size, prompt_length + completion_length), generator=generator)
+    positions = torch.arange(prompt_length + completion_length).unsqueeze(0)
+    prompt_pad = torch.randint(0, prompt_length // 2, (batch_size, 1), generator=generator)
+    completion_end = prompt_length + torch.randint(1, completion_length + 1, (batch_size, 1), generator=generator)
+    input_ids[(positions < prompt_pad) | (positions >= completion_end)] = PAD_TOKEN_ID
+    return input_ids.to(device)
+
+
+def argsort_left_pack_padding(tensor: torch.Tensor, pad_id: int) -> torch.Tensor:
+    """The previous stable argsort + gather implementation, kept as the baseline"""
+    mask = tensor != pad_id
+    sorted_indices = torch.argsort(mask, dim=1, descending=True, stable=True)
+    return torch.gather(tensor, 1, sorted_indices)
+
+
+def argsort_pipeline(input_ids: torch.Tensor, logits_to_keep: int):
+    """What grpo_accumulated_loss did before the fused routine"""
+    left_pad_tokens_per_prompt = calculate_pad_tokens_in_prompt(input_ids, logits_to_keep, PAD_TOKEN_ID)
+    max_left_pad = left_pad_tokens_per_prompt.max().item()
+    packed = argsort_left_pack_padding(input_ids, PAD_TOKEN_ID)
+    completion_input_ids = packed[:, -(logits_to_keep + max_left_pad):]
+    completion_mask = create_completion_attention_mask(
+        completion_input_ids, left_pad_tokens_per_prompt, max_left_pad, PAD_TOKEN_ID
+    )
+    return packed, packed != PAD_TOKEN_ID, completion_input_ids, completion_mask, max_left_pad
+
+
+def check_equivalent(input_ids: torch.Tensor, logits_to_keep: int):
+    expected = argsort_pipeline(input_ids, logits_to_keep)
+    fused = left_pack_padding_with_completion_mask(input_ids, logits_to_keep, PAD_TOKEN_ID)
+    for name, a, b in zip(["input_ids", "attention_mask", "completion_input_ids", "completion_mask"], expected, fused):
+        if not torch.equal(a, b):
+            raise AssertionError(f"Fused routine disagrees with the argsort baseline on {name}")
+    if expected[-1] != fused[-1]:
+        raise AssertionError("Fused routine disagrees with the argsort baseline on max_left_pad")
+    if not torch.equal(left_pack_padding(input_ids, PAD_TOKEN_ID), expected[0]):
+        raise AssertionError("left_pack_padding disagrees with the argsort baseline")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark GRPO left padding packing: argsort vs cumsum/scatter")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--min_run_time", type=float, default=1.0, help="Seconds to time each variant")
+    parser.add_argument("--seed", type=int, default=3407, help="Seed for the synthetic batches")
+    args = parser.parse_args()
+
+    print(f"Device: {args.device}")
+    header = f"{'batch x seq':>14} | {'argsort pack':>12} | {'cumsum pack':>12} | {'speedup':>7} | " \
+             f"{'argsort+masks':>13} | {'fused':>9} | {'speedup':>7}"
+    print(header)
+    print("-" * len(header))
+
+    for batch_size, prompt_length, completion_length in SHAPES:
+        input_ids = make_batch(batch_size, prompt_length, completion_length, args.device, seed=args.seed)
+        check_equivalent(input_ids, completion_length)
+
+        timings = {}
+        for label, stmt in [
+            ("argsort_pack", "argsort_left_pack_padding(input_ids, PAD_TOKEN_ID)"),
+            ("cumsum_pack", "left_pack_padding(input_ids, PAD_TOKEN_ID)"),
+            ("argsort_pipeline", "argsort_pipeline(input_ids, logits_to_keep)"),
+            ("fused", "left_pack_padding_with_completion_mask(input_ids, logits_to_keep, PAD_TOKEN_ID)"),
+        ]:
+            timer = benchmark.Timer(
+                stmt=stmt,
+                globals={**globals(), "input_ids": input_ids, "logits_to_keep": completion_length},
+            )
+            timings[label] = timer.blocked_autorange(min_run_time=args.min_run_time).median * 1e6
+
+        shape = f"{batch_size} x {prompt_length + completion_length}"
+        print(
+            f"{shape:>14} | {timings['argsort_pack']:>10.1f}us | {timings['cumsum_pack']:>10.1f}us | "
+            f"{timings['argsort_pack'] / timings['cumsum_pack']:>6.2f}x | "
+            f"{timings['argsort_pipeline']:>11.1f}us | {timings['fused']:>7.1f}us | "
+            f"{timings['argsort_pipeline'] / timings['fused']:>6.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
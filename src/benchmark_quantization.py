@@ -0,0 +1,277 @@
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+# Add the src directory to the path so we can import our modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from credit_risk_formatter import build_prompt
+from evaluate import MODEL_REGISTRY, compute_metrics, extract_answer, iter_examples
+
+GB = 1024 ** 3
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        # Linux without psutil
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def resolve_variants(specs: List[str]) -> Dict[str, str]:
+    """
+    Map variant names to GGUF paths. Each spec is a GGUF file, a name=path
+    pair, or an export directory written by export.py, which expands to every
+    variant listed in its manifest.json.
+    """
+    variants = {}
+    for spec in specs:
+        name, _, path = spec.rpartition("=")
+        manifest_path = os.path.join(path, "manifest.json")
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                for quant, entry in json.load(f)["files"].items():
+                    variants[f"{name}-{quant}" if name else quant] = os.path.join(path, entry["path"])
+            continue
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"No GGUF file or export directory at {path}")
+        variants[name or os.path.splitext(os.path.basename(path))[0]] = path
+    return variants
+
+
+def timed_predict(llm, example: Dict, generation_config: Dict) -> Dict:
+    """
+    Stream one example and split its latency into prompt processing (until
+    the first token arrives) and decoding (everything after)
+    """
+    prompt = build_prompt(example["question"])
+    prompt_tokens = len(llm.tokenize(prompt.encode("utf-8")))
+    # Without a reset llama-cpp-python reuses the KV cache of the shared prompt prefix,
+    # which would make prompt throughput depend on the order of the examples
+    llm.reset()
+    start_time = time.perf_counter()
+    first_token_time = None
+    parts = []
+    completion_tokens = 0
+    error = None
+    try:
+        for chunk in llm.create_completion(prompt, stream=True, **generation_config):
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+            parts.append(chunk["choices"][0]["text"])
+            # llama-cpp-python streams one chunk per generated token
+            completion_tokens += 1
+    except Exception as e:
+        error = str(e)
+    end_time = time.perf_counter()
+    prediction = "".join(parts)
+    first_token_time = first_token_time or end_time
+    return {
+        "id": example["id"],
+        "expected": example["answer"],
+        "predicted": extract_answer(prediction),
+        "prediction": prediction,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "prompt_seconds": first_token_time - start_time,
+        "decode_seconds": end_time - first_token_time,
+        "elapsed": end_time - start_time,
+        "error": error,
+    }
+
+
+def benchmark_variant(model_name: str, model_path: str, examples: List[Dict], n_threads: int,
+                      generation_config: Dict) -> Dict:
+    """
+    Load one GGUF and run the eval examples through it. Runs in a fresh
+    process per variant so load time and RSS are not skewed by the page cache
+    mappings or allocator state a previous variant left behind.
+    """
+    entry = MODEL_REGISTRY[model_name]
+    baseline_rss = current_rss()
+    start_time = time.perf_counter()
+    llm = entry["loader"](model_path=model_path, n_threads=n_threads)
+    load_seconds = time.perf_counter() - start_time
+    loaded_rss = current_rss()
+
+    # Warm-up generation so one-off allocations do not land on the first timed example
+    llm.create_completion(build_prompt(examples[0]["question"]), max_tokens=1)
+
+    peak_rss = loaded_rss
+    records = []
+    for example in examples:
+        records.append(timed_predict(llm, example, generation_config))
+        peak_rss = max(peak_rss, current_rss())
+
+    metrics = compute_metrics(records)
+    prompt_tokens = sum(r["prompt_tokens"] for r in records)
+    prompt_seconds = sum(r["prompt_seconds"] for r in records)
+    # The first streamed token is produced by the prompt pass, so it is not counted as decoded
+    decode_tokens = sum(max(r["completion_tokens"] - 1, 0) for r in records)
+    decode_seconds = sum(r["decode_seconds"] for r in records)
+    return {
+        "path": model_path,
+        "file_size": os.path.getsize(model_path),
+        "load_seconds": load_seconds,
+        "rss_after_load": loaded_rss - baseline_rss,
+        "peak_rss": peak_rss - baseline_rss,
+        "prompt_tokens_per_second": prompt_tokens / prompt_seconds if prompt_seconds else 0.0,
+        "decode_tokens_per_second": decode_tokens / decode_seconds if decode_seconds else 0.0,
+        "mean_latency": sum(r["elapsed"] for r in records) / len(records),
+        "total": metrics["total"],
+        "accuracy": metrics["accuracy"],
+        "accuracy_ci": metrics["accuracy_ci"],
+        "parse_failure_rate": metrics["parse_failure_rate"],
+        "errors": metrics["errors"],
+        "records": records,
+    }
+
+
+def objectives(result: Dict) -> Tuple[float, float, float]:
+    """Values to maximize: accuracy, decode speed and (negated) peak memory"""
+    return result["accuracy"], result["decode_tokens_per_second"], -result["peak_rss"]
+
+
+def mark_pareto_front(results: Dict[str, Dict]):
+    """Flag every variant that no other variant beats on all of accuracy, speed and memory"""
+    for name, result in results.items():
+        mine = objectives(result)
+        result["pareto"] = not any(
+            all(o >= m for o, m in zip(objectives(other), mine)) and objectives(other) != mine
+            for other in results.values()
+        )
+
+
+def paired_accuracy_difference(reference_records: List[Dict], records: List[Dict],
+                               z: float = 1.96) -> Tuple[float, float, float]:
+    """
+    Accuracy of records minus that of reference_records on the same examples, with
+    a 95% confidence interval (by default) from the paired per-example outcomes.
+    Only examples where exactly one of the two is right move the difference, so
+    two variants that agree almost everywhere get a tight interval even when each
+    accuracy on its own is uncertain.
+    """
+    reference_correct = {r["id"]: r["predicted"] == r["expected"] for r in reference_records}
+    total = gained = lost = 0
+    for record in records:
+        if record["id"] not in reference_correct:
+            continue
+        total += 1
+        correct = record["predicted"] == record["expected"]
+        gained += correct and not reference_correct[record["id"]]
+        lost += reference_correct[record["id"]] and not correct
+    if total == 0:
+        return 0.0, 0.0, 0.0
+    difference = (gained - lost) / total
+    margin = z * math.sqrt(max(gained + lost - (gained - lost) ** 2 / total, 0.0)) / total
+    return difference, difference - margin, difference + margin
+
+
+def recommend(results: Dict[str, Dict], max_accuracy_drop: float) -> str:
+    """
+    Smallest Pareto variant that is confidently no more than max_accuracy_drop
+    less accurate than the most accurate variant: the lower bound of its paired
+    accuracy difference must stay above -max_accuracy_drop. Stores each
+    variant's difference as "accuracy_difference" = (difference, low, high).
+    The most accurate variant itself is always a candidate, so there is always
+    a recommendation.
+    """
+    reference = max(results, key=lambda name: (results[name]["accuracy"], -results[name]["peak_rss"]))
+    for r in results.values():
+        r["accuracy_difference"] = paired_accuracy_difference(results[reference]["records"], r["records"])
+    candidates = [name for name, r in results.items()
+                  if name == reference or (r["pareto"] and r["accuracy_difference"][1] >= -max_accuracy_drop)]
+    return min(candidates, key=lambda name: results[name]["peak_rss"])
+
+
+def print_table(results: Dict[str, Dict]):
+    """Pretty-print the sweep, smallest memory footprint first"""
+    header = (f"{'variant':<24} | {'file':>7} | {'load':>6} | {'peak RSS':>8} | {'prompt t/s':>10} | "
+              f"{'decode t/s':>10} | {'accuracy (95% CI)':>22} | {'vs best (95% CI)':>22} | {'parse fail':>10} | "
+              f"pareto")
+    print(header)
+    print("-" * len(header))
+    for name, r in sorted(results.items(), key=lambda item: item[1]["peak_rss"]):
+        low, high = r["accuracy_ci"]
+        accuracy = f"{r['accuracy'] * 100:.1f}% ({low * 100:.1f}–{high * 100:.1f})"
+        difference, low, high = r["accuracy_difference"]
+        versus_best = f"{difference * 100:+.1f} ({low * 100:+.1f}–{high * 100:+.1f})"
+        print(f"{name:<24} | {r['file_size'] / GB:>5.2f}GB | {r['load_seconds']:>5.1f}s | "
+              f"{r['peak_rss'] / GB:>6.2f}GB | {r['prompt_tokens_per_second']:>10.1f} | "
+              f"{r['decode_tokens_per_second']:>10.1f} | {accuracy:>22} | {versus_best:>22} | "
+              f"{r['parse_failure_rate'] * 100:>9.1f}% | {'✓' if r['pareto'] else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark GGUF quantizations: accuracy vs latency vs memory")
+    parser.add_argument("--variants", nargs="+", required=True,
+                        help="GGUF files, name=path pairs, or export directories with a manifest.json")
+    parser.add_argument("--generation_config", default="qlora", choices=sorted(MODEL_REGISTRY),
+                        help="Registered model whose loader and sampling config are used for every variant")
+    parser.add_argument("--eval_set", default="evaluation_examples.json", help="JSON, JSONL or Parquet file")
+    parser.add_argument("--limit", type=int, default=200, help="Evaluate at most this many examples per variant")
+    parser.add_argument("--n_threads", type=int, default=8, help="llama.cpp threads")
+    parser.add_argument("--question_field", default="question")
+    parser.add_argument("--answer_field", default="answer")
+    parser.add_argument("--sample", action="store_true",
+                        help="Keep the registered sampling config instead of greedy decoding")
+    parser.add_argument("--seed", type=int, default=3407, help="llama.cpp sampling seed")
+    parser.add_argument("--max_accuracy_drop", type=float, default=0.02,
+                        help="Accuracy the recommended variant may lose against the best one, "
+                             "checked against the lower bound of the paired 95%% CI")
+    parser.add_argument("--output_dir", default="eval_results")
+    args = parser.parse_args()
+
+    variants = resolve_variants(args.variants)
+    # Greedy decoding by default, so accuracy differences come from the weights and not from sampling noise
+    generation_config = {**MODEL_REGISTRY[args.generation_config]["generation_config"], "seed": args.seed}
+    if not args.sample:
+        generation_config["temperature"] = 0.0
+    examples = list(itertools.islice(iter_examples(args.eval_set, args.question_field, args.answer_field), args.limit))
+    if not examples:
+        parser.error(f"No examples in {args.eval_set}")
+    print(f"🔬 Benchmarking {len(variants)} variant(s) on {len(examples)} examples from {args.eval_set}")
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name, path in variants.items():
+        print(f"🔄 {name}: {path}")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[name] = executor.submit(
+                benchmark_variant, args.generation_config, path, examples, args.n_threads, generation_config
+            ).result()
+        r = results[name]
+        print(f"   • loaded in {r['load_seconds']:.1f}s, accuracy {r['accuracy'] * 100:.1f}%, "
+              f"{r['decode_tokens_per_second']:.1f} decode tokens/s")
+
+    mark_pareto_front(results)
+    best = recommend(results, args.max_accuracy_drop)
+    print(f"\n📊 QUANTIZATION SWEEP ({len(examples)} examples, "
+          f"{'sampled' if args.sample else 'greedy'} decoding)")
+    print("=" * 80)
+    print_table(results)
+    print(f"\n🏆 Cheapest variant confidently within {args.max_accuracy_drop * 100:.1f} points of the best accuracy: "
+          f"{best} ({results[best]['peak_rss'] / GB:.2f} GB peak RSS)")
+
+    eval_name = os.path.splitext(os.path.basename(args.eval_set))[0]
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, f"{eval_name}.quantization_sweep.json")
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump({"eval_set": args.eval_set, "examples": len(examples), "generation_config": generation_config,
+                   "recommended": best, "variants": results}, f, indent=2)
+    print(f"💾 Saved per-variant metrics and predictions to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,16 @@
+PROMPT_TEMPLATE = """You are a financial risk analysis assistant.
+Respond in the following format:
+<reasoning>
+(your reasoning here)
+</reasoning>
+<answer>
+Choose exactly one of: "Good", "Bad", or "Standard"
+</answer>
+
+{question}
+"""
+
+
 def format_credit_risk_input(age, occupation, annual_income, credit_utilization, 
                             outstanding_debt, payment_behavior, credit_mix):
     """
@@ -33,6 +46,14 @@ def format_credit_risk_input(age, occupation, annual_income, credit_utilization,
     return formatted_input
 
 
+def build_prompt(question):
+    """
+    Wrap a formatted input string in the financial risk analysis prompt
+    shared by the base, LoRA and QLoRA GGUF models
+    """
+    return PROMPT_TEMPLATE.format(question=question)
+
+
 def process_dataset_row(row):
     """
     Process a single row from your dataset.csv
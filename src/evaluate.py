@@ -0,0 +1,355 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, Optional
+
+# Add the src directory to the path so we can import our modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from credit_risk_formatter import PROMPT_TEMPLATE, build_prompt
+from prediction_store import PredictionStore, config_hash, text_hash, wilson_interval
+import load_base_model
+import load_lora_model
+import load_qlora_model
+
+LABELS = ("Good", "Bad", "Standard")
+UNPARSED = "Could not parse"
+
+# Models the harness knows how to load, keyed by the name used on the command line
+MODEL_REGISTRY = {
+    "qlora": {
+        "loader": load_qlora_model.load_qlora_model,
+        "model_path": load_qlora_model.MODEL_PATH,
+        "generation_config": load_qlora_model.GENERATION_CONFIG,
+    },
+    "lora": {
+        "loader": load_lora_model.load_lora_model,
+        "model_path": load_lora_model.MODEL_PATH,
+        "generation_config": load_lora_model.GENERATION_CONFIG,
+    },
+    "base": {
+        "loader": load_base_model.load_base_model,
+        "model_path": load_base_model.MODEL_PATH,
+        "generation_config": load_base_model.GENERATION_CONFIG,
+    },
+}
+
+
+def extract_answer(prediction: str) -> str:
+    """
+    Pull the label out of the <answer>...</answer> block of a model response.
+    Returns UNPARSED when the block is missing or does not hold a known label.
+    """
+    start = prediction.find("<answer>")
+    end = prediction.find("</answer>", start + 1)
+    if start == -1 or end == -1:
+        return UNPARSED
+    answer = prediction[start + len("<answer>"):end].strip().strip('"').strip()
+    return answer if answer in LABELS else UNPARSED
+
+
+def iter_examples(path: str, question_field: str = "question", answer_field: str = "answer") -> Iterator[Dict]:
+    """
+    Yield {"id", "question", "answer"} dicts from a JSON, JSONL or Parquet eval set.
+    JSONL and Parquet are read lazily so large eval sets never sit in memory at once.
+    Examples without an "id" column are identified by their position in the file.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".jsonl", ".ndjson"):
+        def rows():
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+    elif ext == ".parquet":
+        import pyarrow.parquet as pq
+
+        def rows():
+            parquet_file = pq.ParquetFile(path)
+            for batch in parquet_file.iter_batches(batch_size=4096):
+                yield from batch.to_pylist()
+    elif ext == ".json":
+        def rows():
+            with open(path, "r", encoding="utf-8") as f:
+                yield from json.load(f)
+    else:
+        raise ValueError(f"Unsupported eval set format: {path}")
+
+    for index, row in enumerate(rows()):
+        yield {
+            "id": str(row.get("id", index)),
+            "question": row[question_field],
+            "answer": row[answer_field],
+        }
+
+
+def load_completed_ids(checkpoint_path: str) -> set:
+    """Return the ids already scored in a checkpoint file, ignoring a torn final line"""
+    completed = set()
+    if not os.path.exists(checkpoint_path):
+        return completed
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                completed.add(json.loads(line)["id"])
+            except (json.JSONDecodeError, KeyError):
+                continue
+    return completed
+
+
+def iter_records(checkpoint_path: str) -> Iterator[Dict]:
+    """Stream the per-example records of a checkpoint file"""
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def predict(llm, example: Dict, generation_config: Dict) -> Dict:
+    """Run one example through a loaded model and return its checkpoint record"""
+    start_time = time.time()
+    try:
+        output = llm.create_completion(build_prompt(example["question"]), stream=False, **generation_config)
+        prediction = output["choices"][0]["text"]
+        completion_tokens = output.get("usage", {}).get("completion_tokens", 0)
+        error = None
+    except Exception as e:
+        prediction = ""
+        completion_tokens = 0
+        error = str(e)
+    return {
+        "id": example["id"],
+        "expected": example["answer"],
+        "predicted": extract_answer(prediction),
+        "prediction": prediction,
+        "completion_tokens": completion_tokens,
+        "elapsed": time.time() - start_time,
+        "error": error,
+    }
+
+
+def prediction_key(store: PredictionStore, model_name: str, model_path: str, eval_path: str) -> tuple:
+    """Store key of a model on an eval set: (model hash, prompt hash, sampling config hash, eval set)"""
+    eval_set = os.path.splitext(os.path.basename(eval_path))[0]
+    return (store.file_hash(model_path), text_hash(PROMPT_TEMPLATE),
+            config_hash(MODEL_REGISTRY[model_name]["generation_config"]), eval_set)
+
+
+def run_evaluation(model_name: str, eval_path: str, checkpoint_path: str, workers: int = 1,
+                   n_threads: int = 8, model_path: Optional[str] = None, limit: Optional[int] = None,
+                   question_field: str = "question", answer_field: str = "answer",
+                   store: Optional[PredictionStore] = None) -> int:
+    """
+    Score every example of an eval set that is not yet in the checkpoint file.
+
+    Each worker thread owns its own Llama instance (llama.cpp contexts are not
+    thread-safe), and at most two tasks per worker are in flight so memory stays
+    flat regardless of eval set size. Records are appended and flushed as they
+    finish, so an interrupted run resumes where it stopped.
+
+    When a prediction store is given, examples already predicted with the same
+    GGUF, prompt template and sampling config are copied from it instead of
+    being generated again, and models are only loaded if something is missing.
+    """
+    entry = MODEL_REGISTRY[model_name]
+    model_path = model_path or entry["model_path"]
+    completed = load_completed_ids(checkpoint_path)
+    if completed:
+        print(f"♻️ Resuming: {len(completed)} examples already scored in {checkpoint_path}")
+
+    pending_examples = (ex for ex in iter_examples(eval_path, question_field, answer_field) if ex["id"] not in completed)
+    if limit is not None:
+        pending_examples = itertools.islice(pending_examples, limit)
+
+    store_key = prediction_key(store, model_name, model_path, eval_path) if store is not None else None
+
+    models = None
+
+    def load_models():
+        print(f"🔄 Loading {workers} {model_name} model instance(s)...")
+        loaded = queue.Queue()
+        for _ in range(workers):
+            loaded.put(entry["loader"](model_path=model_path, n_threads=n_threads))
+        return loaded
+
+    def score(example):
+        llm = models.get()
+        try:
+            return example, predict(llm, example, entry["generation_config"])
+        finally:
+            models.put(llm)
+
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint_path)), exist_ok=True)
+    scored = cached = 0
+    next_report = 100
+    start_time = time.time()
+    with open(checkpoint_path, "a+", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as executor:
+        # Terminate a record torn by a previous crash so the next one starts on its own line
+        if out.tell() > 0:
+            out.seek(out.tell() - 1)
+            if out.read(1) != "\n":
+                out.write("\n")
+        in_flight = set()
+
+        def drain():
+            nonlocal in_flight, scored, next_report
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            results = [future.result() for future in done]
+            for _, record in results:
+                out.write(json.dumps(record) + "\n")
+            out.flush()
+            if store is not None:
+                store.put_many(store_key, model_name, results)
+            scored += len(results)
+            if scored >= next_report:
+                rate = scored / (time.time() - start_time)
+                print(f"   • {scored} scored ({rate:.2f} examples/s)")
+                next_report += 100
+
+        while True:
+            batch = list(itertools.islice(pending_examples, 256))
+            if not batch:
+                break
+            hits = store.get_many(store_key, batch) if store is not None else {}
+            for example in batch:
+                if example["id"] in hits:
+                    out.write(json.dumps(hits[example["id"]]) + "\n")
+                    cached += 1
+                    continue
+                if models is None:
+                    models = load_models()
+                in_flight.add(executor.submit(score, example))
+                if len(in_flight) >= 2 * workers:
+                    drain()
+            out.flush()
+        while in_flight:
+            drain()
+
+    print(f"✅ Scored {scored} new examples and reused {cached} stored predictions in {time.time() - start_time:.1f}s")
+    return scored
+
+
+def compute_metrics(records) -> Dict:
+    """
+    Aggregate accuracy, per-class precision/recall, the confusion matrix,
+    parse-failure rate and decode throughput from an iterable of records
+    """
+    confusion = Counter()
+    total = correct = unparsed = errors = 0
+    completion_tokens = 0
+    elapsed = 0.0
+    for record in records:
+        total += 1
+        confusion[(record["expected"], record["predicted"])] += 1
+        correct += record["predicted"] == record["expected"]
+        unparsed += record["predicted"] == UNPARSED
+        errors += record.get("error") is not None
+        completion_tokens += record.get("completion_tokens", 0)
+        elapsed += record.get("elapsed", 0.0)
+
+    per_class = {}
+    for label in LABELS:
+        true_positive = confusion[(label, label)]
+        predicted_as = sum(count for (_, predicted), count in confusion.items() if predicted == label)
+        actual = sum(count for (expected, _), count in confusion.items() if expected == label)
+        per_class[label] = {
+            "precision": true_positive / predicted_as if predicted_as else 0.0,
+            "recall": true_positive / actual if actual else 0.0,
+            "support": actual,
+        }
+
+    columns = list(LABELS) + [UNPARSED]
+    return {
+        "total": total,
+        "correct": correct,
+        "accuracy": correct / total if total else 0.0,
+        "accuracy_ci": wilson_interval(correct, total),
+        "parse_failure_rate": unparsed / total if total else 0.0,
+        "errors": errors,
+        "per_class": per_class,
+        "confusion_matrix": {
+            expected: {predicted: confusion[(expected, predicted)] for predicted in columns}
+            for expected in LABELS
+        },
+        "tokens_per_second": completion_tokens / elapsed if elapsed else 0.0,
+    }
+
+
+def print_report(model_name: str, metrics: Dict):
+    """Pretty-print the metrics of one model"""
+    print(f"\n📊 {model_name.upper()} EVALUATION ({metrics['total']} examples)")
+    print("=" * 80)
+    low, high = metrics["accuracy_ci"]
+    print(f"🎯 Accuracy: {metrics['correct']}/{metrics['total']} = {metrics['accuracy'] * 100:.1f}% "
+          f"(95% CI {low * 100:.1f}–{high * 100:.1f}%)")
+    print(f"❓ Parse failures: {metrics['parse_failure_rate'] * 100:.1f}%  (errors: {metrics['errors']})")
+    print(f"⚡ Decode speed: {metrics['tokens_per_second']:.1f} tokens/s")
+
+    print("\nPer-class:")
+    for label, stats in metrics["per_class"].items():
+        print(f"   • {label:<9} precision {stats['precision'] * 100:5.1f}%  "
+              f"recall {stats['recall'] * 100:5.1f}%  support {stats['support']}")
+
+    columns = list(LABELS) + [UNPARSED]
+    print("\nConfusion matrix (rows = expected, columns = predicted):")
+    print(" " * 10 + "".join(f"{c[:9]:>10}" for c in columns))
+    for expected, row in metrics["confusion_matrix"].items():
+        print(f"{expected:<10}" + "".join(f"{row[c]:>10}" for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate registered GGUF models on a credit risk eval set")
+    parser.add_argument("--models", nargs="+", default=["qlora"], choices=sorted(MODEL_REGISTRY))
+    parser.add_argument("--eval_set", default="evaluation_examples.json", help="JSON, JSONL or Parquet file")
+    parser.add_argument("--output_dir", default="eval_results")
+    parser.add_argument("--workers", type=int, default=1, help="Model instances generating concurrently")
+    parser.add_argument("--n_threads", type=int, default=8, help="llama.cpp threads per model instance")
+    parser.add_argument("--model_path", default=None, help="Override the GGUF path (single model only)")
+    parser.add_argument("--limit", type=int, default=None, help="Score at most this many new examples")
+    parser.add_argument("--question_field", default="question")
+    parser.add_argument("--answer_field", default="answer")
+    parser.add_argument("--store", default=os.path.join("eval_results", "predictions.db"),
+                        help="SQLite prediction store shared across runs")
+    parser.add_argument("--no_store", action="store_true", help="Always regenerate every prediction")
+    args = parser.parse_args()
+
+    if args.model_path and len(args.models) > 1:
+        parser.error("--model_path can only be used with a single model")
+
+    eval_name = os.path.splitext(os.path.basename(args.eval_set))[0]
+    store = None if args.no_store else PredictionStore(args.store)
+    for model_name in args.models:
+        run_name = eval_name
+        if store is not None:
+            # A new model file, prompt or sampling config starts a new checkpoint instead of resuming a stale one
+            model_path = args.model_path or MODEL_REGISTRY[model_name]["model_path"]
+            run_name += "." + text_hash("".join(prediction_key(store, model_name, model_path, args.eval_set)))[:12]
+        checkpoint_path = os.path.join(args.output_dir, model_name, f"{run_name}.predictions.jsonl")
+        run_evaluation(
+            model_name,
+            args.eval_set,
+            checkpoint_path,
+            workers=args.workers,
+            n_threads=args.n_threads,
+            model_path=args.model_path,
+            limit=args.limit,
+            question_field=args.question_field,
+            answer_field=args.answer_field,
+            store=store,
+        )
+        metrics = compute_metrics(iter_records(checkpoint_path))
+        print_report(model_name, metrics)
+        with open(os.path.join(args.output_dir, model_name, f"{run_name}.metrics.json"), "w") as f:
+            json.dump(metrics, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
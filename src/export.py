@@ -0,0 +1,293 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+# Bump when the merge or conversion changes, so cached exports are rebuilt
+EXPORT_FORMAT_VERSION = 1
+
+QUANT_TYPES = ("f16", "q8_0", "q5_K_M", "q4_K_M")
+DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16}
+
+# Merged tensors are flushed to a new safetensors shard once this many bytes are buffered
+MAX_SHARD_BYTES = 2 * 1024 ** 3
+
+# Base model files with these suffixes are weights; the rest (config, tokenizer, chat template) is copied as is
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth", ".gguf")
+
+
+def resolve_base_model(base: str) -> str:
+    """Local directory of the base model, downloading only its safetensors and tokenizer files from the Hub"""
+    if os.path.isdir(base):
+        return base
+    from huggingface_hub import snapshot_download
+    return snapshot_download(
+        base, allow_patterns=["*.safetensors", "*.json", "*.txt", "*.model", "*.tiktoken", "*.jinja"]
+    )
+
+
+def file_sha256(path: str, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            digest.update(block)
+    return digest
+
+
+def export_hash(checkpoint_dir: str, base_dir: str, dtype: str) -> str:
+    """
+    Cache key of an export: the adapter config and weights, the base model files
+    (by name, size and mtime, which also covers the Hub snapshot's commit) and
+    the merge dtype
+    """
+    digest = hashlib.sha256(f"v{EXPORT_FORMAT_VERSION}:{dtype}".encode("utf-8"))
+    for name in ("adapter_config.json", "adapter_model.safetensors"):
+        file_sha256(os.path.join(checkpoint_dir, name), digest)
+    for path in sorted(glob.glob(os.path.join(base_dir, "*"))):
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def pattern_value(patterns: Dict, module: str, default):
+    """peft's rank_pattern/alpha_pattern lookup: a key matches a module name suffix"""
+    for pattern, value in patterns.items():
+        if re.match(rf"(.*\.)?({pattern})$", module):
+            return value
+    return default
+
+
+def load_adapter(checkpoint_dir: str) -> Tuple[Dict, Dict, bool]:
+    """
+    Read a PEFT LoRA checkpoint into {base weight name: (lora_A, lora_B, scale)},
+    {base weight name: tensor} for modules saved whole (modules_to_save) and its
+    fan_in_fan_out flag. The adapter is small (~119 MB at r=32), so it is held
+    in memory.
+    """
+    with open(os.path.join(checkpoint_dir, "adapter_config.json"), "r", encoding="utf-8") as f:
+        config = json.load(f)
+    if config.get("peft_type", "LORA") != "LORA" or config.get("use_dora"):
+        raise ValueError(f"Only plain LoRA adapters can be merged, got {config.get('peft_type')} "
+                         f"(use_dora={config.get('use_dora')})")
+
+    lora_a, lora_b, whole = {}, {}, {}
+    with safe_open(os.path.join(checkpoint_dir, "adapter_model.safetensors"), framework="pt") as f:
+        for key in f.keys():
+            name = key.removeprefix("base_model.model.")
+            if ".lora_A." in name:
+                lora_a[name.split(".lora_A.")[0]] = f.get_tensor(key)
+            elif ".lora_B." in name:
+                lora_b[name.split(".lora_B.")[0]] = f.get_tensor(key)
+            else:
+                whole[name] = f.get_tensor(key)
+
+    lora = {}
+    for module, a in lora_a.items():
+        rank = a.shape[0]
+        alpha = pattern_value(config.get("alpha_pattern") or {}, module, config["lora_alpha"])
+        scale = alpha / rank ** 0.5 if config.get("use_rslora") else alpha / rank
+        lora[f"{module}.weight"] = (a, lora_b[module], scale)
+    return lora, whole, bool(config.get("fan_in_fan_out"))
+
+
+def merge_tensor(weight: torch.Tensor, lora_a: torch.Tensor, lora_b: torch.Tensor, scale: float,
+                 fan_in_fan_out: bool, dtype: torch.dtype) -> torch.Tensor:
+    """W + scale * B @ A, accumulated in float32"""
+    delta = (lora_b.float() @ lora_a.float()) * scale
+    if fan_in_fan_out:
+        delta = delta.T
+    return (weight.float() + delta).to(dtype)
+
+
+def stream_merge(base_dir: str, checkpoint_dir: str, out_dir: str, dtype: torch.dtype,
+                 max_shard_bytes: int = MAX_SHARD_BYTES) -> int:
+    """
+    Merge a LoRA checkpoint into the base weights one tensor at a time and write
+    the result as safetensors shards, so peak memory is one shard plus the
+    adapter instead of the whole model. Returns the number of merged tensors.
+    """
+    lora, whole, fan_in_fan_out = load_adapter(checkpoint_dir)
+    base_files = sorted(glob.glob(os.path.join(base_dir, "*.safetensors")))
+    if not base_files:
+        raise FileNotFoundError(f"No safetensors weights in {base_dir}")
+
+    weight_map, shard, shard_bytes, total_bytes, merged = {}, {}, 0, 0, 0
+
+    def flush():
+        nonlocal shard, shard_bytes
+        if not shard:
+            return
+        shard_name = f"model-{len(set(weight_map.values())) + 1:05d}.safetensors"
+        save_file(shard, os.path.join(out_dir, shard_name), metadata={"format": "pt"})
+        weight_map.update((name, shard_name) for name in shard)
+        shard, shard_bytes = {}, 0
+
+    for path in base_files:
+        with safe_open(path, framework="pt") as f:
+            for name in f.keys():
+                if name.endswith((".absmax", ".quant_map", ".quant_state.bitsandbytes__nf4", ".nested_absmax")):
+                    raise ValueError(f"{base_dir} holds bitsandbytes-quantized weights; "
+                                     "pass --base with the 16-bit model")
+                tensor = whole.pop(name, None)
+                if tensor is None:
+                    tensor = f.get_tensor(name)
+                if name in lora:
+                    tensor = merge_tensor(tensor, *lora.pop(name), fan_in_fan_out, dtype)
+                    merged += 1
+                elif tensor.is_floating_point():
+                    tensor = tensor.to(dtype)
+                shard[name] = tensor.contiguous()
+                shard_bytes += tensor.numel() * tensor.element_size()
+                total_bytes += tensor.numel() * tensor.element_size()
+                if shard_bytes >= max_shard_bytes:
+                    flush()
+    # Whole modules the base checkpoint does not store itself (e.g. an untied lm_head)
+    for name, tensor in whole.items():
+        shard[name] = tensor.to(dtype).contiguous()
+        total_bytes += tensor.numel() * shard[name].element_size()
+    flush()
+
+    if lora:
+        raise ValueError(f"{len(lora)} LoRA modules have no base weight, e.g. {next(iter(lora))}; "
+                         "is --base the model the adapter was trained on?")
+    with open(os.path.join(out_dir, "model.safetensors.index.json"), "w", encoding="utf-8") as f:
+        json.dump({"metadata": {"total_size": total_bytes}, "weight_map": weight_map}, f, indent=2)
+    for path in glob.glob(os.path.join(base_dir, "*")):
+        name = os.path.basename(path)
+        if os.path.isfile(path) and not name.endswith(WEIGHT_SUFFIXES) and name != "model.safetensors.index.json":
+            shutil.copy(path, os.path.join(out_dir, name))
+    return merged
+
+
+def find_llama_cpp_tools(llama_cpp_dir: str) -> Tuple[str, Optional[str]]:
+    """Paths of llama.cpp's convert_hf_to_gguf.py and llama-quantize (None if it is not built)"""
+    convert_script = os.path.join(llama_cpp_dir, "convert_hf_to_gguf.py")
+    if not os.path.isfile(convert_script):
+        raise FileNotFoundError(f"{convert_script} not found; clone llama.cpp there or pass --llama_cpp")
+    exe = ".exe" if os.name == "nt" else ""
+    candidates = [os.path.join(llama_cpp_dir, "build", "bin", f"llama-quantize{exe}"),
+                  os.path.join(llama_cpp_dir, "build", "bin", "Release", f"llama-quantize{exe}"),
+                  shutil.which("llama-quantize")]
+    quantize = next((path for path in candidates if path and os.path.isfile(path)), None)
+    return convert_script, quantize
+
+
+def run(command: List[str]):
+    print(f"   $ {' '.join(command)}")
+    subprocess.run(command, check=True)
+
+
+def export(checkpoint_dir: str, base: str, quant_types: List[str], output_dir: str = "exports",
+           name: Optional[str] = None, dtype: str = "float16", llama_cpp_dir: str = "llama.cpp",
+           n_threads: int = 8) -> Dict[str, str]:
+    """
+    Export a LoRA checkpoint to GGUF files, one per quantization type.
+
+    The checkpoint is merged into the base model tensor by tensor, converted to
+    an f16 GGUF once with llama.cpp's converter, and every other type is
+    quantized from that file. Results are cached under a hash of the adapter,
+    the base model and the dtype, so re-running only builds the missing types.
+    The merged shards are deleted, and so is the f16 intermediate unless it was
+    requested or already exported by an earlier call.
+    Returns {quant type: GGUF path}.
+    """
+    base_dir = resolve_base_model(base)
+    if name is None:
+        name = f"{os.path.basename(os.path.normpath(base)).lower()}-{os.path.basename(os.path.normpath(checkpoint_dir))}"
+    digest = export_hash(checkpoint_dir, base_dir, dtype)
+    export_dir = os.path.join(output_dir, f"{name}-{digest[:12]}")
+    paths = {quant: os.path.join(export_dir, f"{name}-{quant}.gguf") for quant in quant_types}
+    missing = [quant for quant in quant_types if not os.path.isfile(paths[quant])]
+    if not missing:
+        print(f"♻️ All requested variants already exported for this checkpoint in {export_dir}")
+        return paths
+
+    convert_script, quantize = find_llama_cpp_tools(llama_cpp_dir)
+    if any(quant != "f16" for quant in missing) and quantize is None:
+        raise FileNotFoundError(f"llama-quantize not found; build llama.cpp in {llama_cpp_dir} or put it on PATH")
+    os.makedirs(export_dir, exist_ok=True)
+    f16_path = os.path.join(export_dir, f"{name}-f16.gguf")
+    # An f16 GGUF left by an earlier export is a cached variant, so only an intermediate built here is removed
+    created_f16 = not os.path.isfile(f16_path)
+    keep_f16 = "f16" in quant_types or not created_f16
+    start_time = time.time()
+
+    if created_f16:
+        merged_dir = tempfile.mkdtemp(prefix=".merged-", dir=export_dir)
+        try:
+            print(f"🔀 Merging {checkpoint_dir} into {base} ({dtype})...")
+            merged = stream_merge(base_dir, checkpoint_dir, merged_dir, DTYPES[dtype])
+            print(f"   • {merged} LoRA modules merged in {time.time() - start_time:.1f}s")
+            print("📦 Converting to GGUF (f16)...")
+            run([sys.executable, convert_script, merged_dir, "--outfile", f"{f16_path}.tmp", "--outtype", "f16"])
+            os.replace(f"{f16_path}.tmp", f16_path)
+        finally:
+            shutil.rmtree(merged_dir, ignore_errors=True)
+
+    for quant in missing:
+        if quant == "f16":
+            continue
+        print(f"🗜️ Quantizing to {quant}...")
+        run([quantize, f16_path, f"{paths[quant]}.tmp", quant.upper(), str(n_threads)])
+        os.replace(f"{paths[quant]}.tmp", paths[quant])
+    if not keep_f16:
+        os.remove(f16_path)
+
+    manifest = {
+        "checkpoint": os.path.abspath(checkpoint_dir),
+        "base": base,
+        "dtype": dtype,
+        "hash": digest,
+        "files": {
+            quant: {"path": os.path.basename(path), "size": os.path.getsize(path)} for quant, path in paths.items()
+        },
+    }
+    manifest_path = os.path.join(export_dir, "manifest.json")
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest["files"] = {**json.load(f).get("files", {}), **manifest["files"]}
+    # Drop entries whose files were deleted since they were exported
+    manifest["files"] = {
+        quant: entry for quant, entry in manifest["files"].items()
+        if os.path.isfile(os.path.join(export_dir, entry["path"]))
+    }
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"✅ Exported {len(missing)} variant(s) in {time.time() - start_time:.1f}s")
+    for quant, path in paths.items():
+        print(f"   • {quant:<7} {os.path.getsize(path) / 1024 ** 3:5.2f} GB  {path}")
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge a LoRA checkpoint into its base model and export GGUF variants")
+    parser.add_argument("--checkpoint", required=True, help="PEFT checkpoint, e.g. outputs/checkpoint-100")
+    parser.add_argument("--base", default="Qwen/Qwen2.5-3B-Instruct", help="16-bit base model (Hub id or directory)")
+    parser.add_argument("--quant", nargs="+", default=["f16"], choices=QUANT_TYPES)
+    parser.add_argument("--output_dir", default="exports")
+    parser.add_argument("--name", default=None, help="File name prefix, defaults to <base>-<checkpoint>")
+    parser.add_argument("--dtype", default="float16", choices=sorted(DTYPES), help="Dtype of the merged weights")
+    parser.add_argument("--llama_cpp", default=os.environ.get("LLAMA_CPP_DIR", "llama.cpp"),
+                        help="llama.cpp checkout with convert_hf_to_gguf.py and a built llama-quantize")
+    parser.add_argument("--n_threads", type=int, default=8, help="llama-quantize threads")
+    args = parser.parse_args()
+
+    export(args.checkpoint, args.base, args.quant, output_dir=args.output_dir, name=args.name,
+           dtype=args.dtype, llama_cpp_dir=args.llama_cpp, n_threads=args.n_threads)
+
+
+if __name__ == "__main__":
+    main()
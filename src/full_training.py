@@ -1,14 +1,32 @@
 from unsloth import FastLanguageModel
-from trl import SFTTrainer
-from transformers import TrainingArguments
-from datasets import Dataset
-import json
+from trl import SFTConfig, SFTTrainer
+from transformers import DataCollatorForLanguageModeling
+import os
 import torch
 
+from training_data import (
+    load_training_data,
+    pretokenize_dataset,
+    pack_sequences,
+    packing_efficiency,
+    PackedSequenceCollator,
+    packed_attention_mode,
+    compute_token_lengths,
+    LengthGroupedSampler,
+    install_train_sampler,
+)
+
 # Model configuration
 model_name = "unsloth/phi-2-bnb-4bit"  # 2.7B parameters - efficient and powerful
 max_seq_length = 1024  # Reduced sequence length
 dtype = None
+packing = True  # Concatenate short examples into full-length sequences
+packed_attention = None  # None picks from the model: "position_ids" under flash_attention_2, else "block_diagonal"
+group_by_length = True  # Batch rows of similar length (packed sequences when packing) to cut padding
+per_device_train_batch_size = 4  # Several rows per step, so grouping by length has padding to remove
+gradient_accumulation_steps = 2
+# Windows spawns worker processes by re-running this script (and reloading the model), so stay serial there
+num_proc = 1 if os.name == "nt" else os.cpu_count()
 
 print("🦥 Loading model and tokenizer...")
 # Load model and tokenizer
@@ -43,24 +61,34 @@ model = FastLanguageModel.get_peft_model(
 
 print("✅ LoRA adapters added successfully!")
 
-# Load training data
-def load_training_data():
-    """Load and prepare training data from JSON file"""
-    with open('training_data.json', 'r') as f:
-        data = json.load(f)
-    
-    # Convert to the format expected by SFTTrainer
-    formatted_data = []
-    for item in data:
-        # Combine input and output into a single text field
-        text = f"### Input:\n{item['input']}\n\n### Output:\n{item['output']}"
-        formatted_data.append({"text": text})
-    
-    return Dataset.from_list(formatted_data)
-
 print("📊 Loading training data...")
-dataset = load_training_data()
+dataset = load_training_data("training_data.json")  # .jsonl / .parquet are streamed lazily
 print(f"✅ Loaded {len(dataset)} training examples")
+num_examples = len(dataset)
+
+# Tokenize in parallel once; later runs load the cached ids and skip tokenization entirely
+print("🔤 Tokenizing training data...")
+dataset = pretokenize_dataset(dataset, tokenizer, max_seq_length, add_eos=packing, num_proc=num_proc)
+
+data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+if packing:
+    # Credit-risk examples are ~80-150 tokens, so unpacked sequences are mostly padding
+    print("📦 Packing training examples...")
+    dataset = pack_sequences(dataset, max_seq_length)
+    attention_mode = packed_attention_mode(model)
+    if packed_attention is None:
+        packed_attention = attention_mode
+    elif packed_attention == "position_ids" and attention_mode != "position_ids":
+        # Without FlashAttention-2 reset position_ids leave every example attending to the ones packed before it
+        raise ValueError(f"packed_attention='position_ids' needs flash_attention_2, but the model uses "
+                         f"{model.config._attn_implementation}; use 'block_diagonal' instead")
+    data_collator = PackedSequenceCollator(
+        pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+        attention=packed_attention,
+        mask_dtype=model.dtype,
+    )
+    print(f"✅ Packed {num_examples} examples into {len(dataset)} sequences "
+          f"({packing_efficiency(dataset, max_seq_length) * 100:.1f}% packing efficiency)")
 
 # Training arguments optimized for Unsloth
 print("⚙️ Configuring training arguments...")
@@ -68,12 +96,15 @@ trainer = SFTTrainer(
     model=model,
     tokenizer=tokenizer,
     train_dataset=dataset,
-    dataset_text_field="text",
-    max_seq_length=max_seq_length,
-    dataset_num_proc=1,  # Disable multiprocessing
-    args=TrainingArguments(
-        per_device_train_batch_size=1,  # Reduced batch size
-        gradient_accumulation_steps=8,  # Effective batch size = 8
+    data_collator=data_collator,
+    # Unsloth's SFTConfig; plain TrainingArguments has no async_checkpointing/dedup_checkpoint_files
+    args=SFTConfig(
+        dataset_text_field="text",
+        max_seq_length=max_seq_length,
+        dataset_num_proc=num_proc,
+        dataset_kwargs={"skip_prepare_dataset": True},  # Already tokenized by pretokenize_dataset
+        per_device_train_batch_size=per_device_train_batch_size,
+        gradient_accumulation_steps=gradient_accumulation_steps,  # Effective batch size = 8
         warmup_steps=10,
         num_train_epochs=3,
         learning_rate=2e-4,
@@ -88,20 +119,39 @@ trainer = SFTTrainer(
         save_strategy="epoch",
         save_total_limit=2,
         dataloader_pin_memory=False,
-        dataloader_num_workers=0,  # Disable multiprocessing
+        dataloader_num_workers=0 if os.name == "nt" else 2,
+        remove_unused_columns=not packing,  # The packing collator needs "seq_lengths"
+        async_checkpointing=True,  # Write checkpoints on a background thread from a CPU snapshot
+        dedup_checkpoint_files=True,  # Hard-link files that did not change since the previous checkpoint
     ),
 )
 
+# Installed with or without packing: packed rows still differ in length, and the sampler is resumable,
+# so trainer.train(resume_from_checkpoint=...) seeks to the saved position instead of replaying batches.
+# A mega batch of one batch leaves the shuffled order ungrouped.
+lengths = compute_token_lengths(dataset, tokenizer)
+install_train_sampler(trainer, LengthGroupedSampler(
+    lengths,
+    batch_size=per_device_train_batch_size,
+    mega_batch_size=50 if group_by_length else 1,
+    seed=3407,
+))
+if group_by_length:
+    print(f"📏 Batching {'packed sequences' if packing else 'examples'} by token length")
+
 print("✅ SFTTrainer configured successfully!")
 print(f"\n🎯 Training Configuration:")
 print(f"- Model: {model_name}")
 print(f"- LoRA rank: 64")
-print(f"- Batch size: 2 per device")
-print(f"- Gradient accumulation: 4 steps (effective batch size: 8)")
+print(f"- Batch size: {per_device_train_batch_size} per device")
+print(f"- Gradient accumulation: {gradient_accumulation_steps} steps "
+      f"(effective batch size: {per_device_train_batch_size * gradient_accumulation_steps})")
 print(f"- Epochs: 3")
 print(f"- Learning rate: 2e-4")
 print(f"- Warmup steps: 10")
-print(f"- Training examples: {len(dataset)}")
+print(f"- Training examples: {num_examples}")
+if packing:
+    print(f"- Packed sequences: {len(dataset)} ({packed_attention} attention isolation)")
 print(f"- Output directory: outputs")
 
 print(f"\n🚀 Ready to start training!")
@@ -1,14 +1,21 @@
 from llama_cpp import Llama
-from credit_risk_formatter import format_credit_risk_input
+from credit_risk_formatter import format_credit_risk_input, build_prompt
+from stream_renderer import StreamRenderer
 
-def load_lora_model():
+MODEL_PATH = r"D:\Narwal\fine-tuning-lora-qlora\qwen2.5-3b--lora-f16.gguf"
+
+GENERATION_CONFIG = {
+    "max_tokens": 256,
+}
+
+def load_lora_model(model_path=MODEL_PATH, n_threads=8):
     """
     Load the LoRA fine-tuned model
     """
     llm = Llama(
-        model_path=r"D:\Narwal\fine-tuning-lora-qlora\qwen2.5-3b--lora-f16.gguf",
+        model_path=model_path,
         n_ctx=2048,
-        n_threads=8,
+        n_threads=n_threads,
         n_batch=512,
         verbose=False
     )
@@ -21,28 +28,19 @@ def ask_financial_risk_lora(question: str, llm=None, streamlit_container=None):
     if llm is None:
         llm = load_lora_model()
     
-    prompt = f"""You are a financial risk analysis assistant.
-Respond in the following format:
-<reasoning>
-(your reasoning here)
-</reasoning>
-<answer>
-Choose exactly one of: "Good", "Bad", or "Standard"
-</answer>
-
-{question}
-"""
-    full = ""
-    for chunk in llm.create_completion(prompt, max_tokens=256, stream=True):
+    prompt = build_prompt(question)
+    renderer = StreamRenderer(streamlit_container) if streamlit_container else None
+    parts = []
+    for chunk in llm.create_completion(prompt, stream=True, **GENERATION_CONFIG):
         text = chunk["choices"][0]["text"]
-        if streamlit_container:
-            # Escape HTML characters to prevent JavaScript errors
-            escaped_text = (full + text).replace('<', '&lt;').replace('>', '&gt;')
-            streamlit_container.markdown(f'<div class="streaming-text">{escaped_text}</div>', unsafe_allow_html=True)
+        if renderer:
+            renderer.write(text)
         else:
             print(text, end="", flush=True)
-        full += text
-    return full
+        parts.append(text)
+    if renderer:
+        renderer.flush()
+    return "".join(parts)
 
 if __name__ == "__main__":
     # Test the LoRA model
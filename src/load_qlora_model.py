@@ -1,14 +1,25 @@
 from llama_cpp import Llama
-from credit_risk_formatter import format_credit_risk_input
+from credit_risk_formatter import format_credit_risk_input, build_prompt
+from stream_renderer import StreamRenderer
 
-def load_qlora_model():
+MODEL_PATH = r"D:\Narwal\fine-tuning-lora-qlora\qwen2.5-3b-f16-qlora.gguf"
+
+GENERATION_CONFIG = {
+    "max_tokens": 500,
+    "temperature": 0.3,
+    "top_p": 0.9,
+    "repeat_penalty": 1.2,
+    "top_k": 40,
+}
+
+def load_qlora_model(model_path=MODEL_PATH, n_threads=8):
     """
     Load the QLoRA fine-tuned model
     """
     llm = Llama(
-        model_path=r"D:\Narwal\fine-tuning-lora-qlora\qwen2.5-3b-f16-qlora.gguf",
+        model_path=model_path,
         n_ctx=2048,
-        n_threads=8,
+        n_threads=n_threads,
         n_batch=512,
         verbose=False
     )
@@ -21,35 +32,19 @@ def ask_financial_risk_qlora(question: str, llm=None, streamlit_container=None):
     if llm is None:
         llm = load_qlora_model()
     
-    prompt = f"""You are a financial risk analysis assistant.
-Respond in the following format:
-<reasoning>
-(your reasoning here)
-</reasoning>
-<answer>
-Choose exactly one of: "Good", "Bad", or "Standard"
-</answer>
-
-{question}
-"""
-    full = ""
-    for chunk in llm.create_completion(
-        prompt,
-        max_tokens=500,
-        stream=True,
-        temperature=0.3,
-        top_p=0.9,
-        repeat_penalty=1.2,
-        top_k=40
-    ):
+    prompt = build_prompt(question)
+    renderer = StreamRenderer(streamlit_container) if streamlit_container else None
+    parts = []
+    for chunk in llm.create_completion(prompt, stream=True, **GENERATION_CONFIG):
         text = chunk["choices"][0]["text"]
-        if streamlit_container:
-            escaped_text = (full + text).replace('<', '&lt;').replace('>', '&gt;')
-            streamlit_container.markdown(f'<div class="streaming-text">{escaped_text}</div>', unsafe_allow_html=True)
+        if renderer:
+            renderer.write(text)
         else:
             print(text, end="", flush=True)
-        full += text
-    return full
+        parts.append(text)
+    if renderer:
+        renderer.flush()
+    return "".join(parts)
 
 if __name__ == "__main__":
     # Test the QLoRA model
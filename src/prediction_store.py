@@ -0,0 +1,176 @@
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    model_hash TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    config_hash TEXT NOT NULL,
+    eval_set TEXT NOT NULL,
+    example_id TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    model_name TEXT NOT NULL,
+    expected TEXT,
+    predicted TEXT NOT NULL,
+    prediction TEXT NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    elapsed REAL NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (model_hash, prompt_hash, config_hash, eval_set, example_id)
+);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+"""
+
+
+def text_hash(text: str) -> str:
+    """SHA-256 of a string"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def config_hash(config: Dict) -> str:
+    """Order-independent hash of a sampling config"""
+    return text_hash(json.dumps(config, sort_keys=True))
+
+
+def wilson_interval(correct: int, total: int, z: float = 1.96) -> Tuple[float, float]:
+    """Wilson score confidence interval of an accuracy (95% by default)"""
+    if total == 0:
+        return 0.0, 0.0
+    p = correct / total
+    denominator = 1 + z * z / total
+    center = (p + z * z / (2 * total)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+class PredictionStore:
+    """
+    Persistent cache of model predictions backed by a single SQLite file.
+
+    A prediction is reused only when the GGUF file, the prompt template, the
+    sampling config and the example text are all unchanged, so re-running an
+    evaluation only pays for what actually changed. The connection is not
+    shared across threads; callers read and write from one thread.
+    """
+
+    def __init__(self, path: str, read_only: bool = False):
+        self.path = path
+        if read_only:
+            self.conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def file_hash(self, path: str) -> str:
+        """
+        SHA-256 of a model file. Hashing a multi-GB GGUF takes a while, so the
+        digest is remembered per (path, size, mtime) and only recomputed when
+        the file changes.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.conn.execute(
+            "SELECT sha256 FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        if row:
+            return row[0]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+                digest.update(block)
+        sha256 = digest.hexdigest()
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, sha256),
+            )
+        return sha256
+
+    def get_many(self, key: Tuple[str, str, str, str], examples: List[Dict]) -> Dict[str, Dict]:
+        """
+        Look up stored records for a batch of examples under
+        key = (model_hash, prompt_hash, config_hash, eval_set).
+        Examples whose question text changed since they were stored are misses.
+        """
+        found = {}
+        ids = [example["id"] for example in examples]
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self.conn.execute(
+                "SELECT example_id, input_hash, predicted, prediction, completion_tokens, elapsed "
+                "FROM predictions WHERE model_hash = ? AND prompt_hash = ? AND config_hash = ? AND eval_set = ? "
+                f"AND example_id IN ({','.join('?' * len(chunk))})",
+                (*key, *chunk),
+            ).fetchall()
+            for example_id, input_hash, predicted, prediction, completion_tokens, elapsed in rows:
+                found[example_id] = {
+                    "input_hash": input_hash,
+                    "predicted": predicted,
+                    "prediction": prediction,
+                    "completion_tokens": completion_tokens,
+                    "elapsed": elapsed,
+                }
+
+        hits = {}
+        for example in examples:
+            stored = found.get(example["id"])
+            if stored and stored.pop("input_hash") == text_hash(example["question"]):
+                hits[example["id"]] = {"id": example["id"], "expected": example["answer"], **stored, "error": None}
+        return hits
+
+    def put_many(self, key: Tuple[str, str, str, str], model_name: str, pairs: Iterable[Tuple[Dict, Dict]]):
+        """Store (example, record) pairs, skipping records whose generation errored"""
+        now = time.time()
+        rows = [
+            (*key, example["id"], text_hash(example["question"]), model_name, record["expected"],
+             record["predicted"], record["prediction"], record["completion_tokens"], record["elapsed"], now)
+            for example, record in pairs
+            if record.get("error") is None
+        ]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def summarize(self) -> Dict[str, Dict]:
+        """
+        Accuracy of each model's most recent evaluation, i.e. the latest
+        (model file, prompt, sampling config, eval set) it was scored under.
+        """
+        rows = self.conn.execute(
+            "SELECT model_name, eval_set, COUNT(*), SUM(predicted = expected), "
+            "SUM(completion_tokens), SUM(elapsed), MAX(created_at) "
+            "FROM predictions GROUP BY model_name, model_hash, prompt_hash, config_hash, eval_set"
+        ).fetchall()
+
+        summary = {}
+        for model_name, eval_set, total, correct, completion_tokens, elapsed, updated_at in rows:
+            if model_name in summary and summary[model_name]["updated_at"] >= updated_at:
+                continue
+            summary[model_name] = {
+                "eval_set": eval_set,
+                "total": total,
+                "correct": correct,
+                "accuracy": correct / total,
+                "accuracy_ci": wilson_interval(correct, total),
+                "tokens_per_second": completion_tokens / elapsed if elapsed else 0.0,
+                "updated_at": updated_at,
+            }
+        return summary
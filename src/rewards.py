@@ -0,0 +1,146 @@
+import re
+import threading
+import time
+from typing import Dict, List, NamedTuple
+
+VALID_LABELS = {"Good", "Bad", "Standard"}
+
+# Compiled once at import instead of on every reward call
+STRICT_FORMAT = re.compile(r"^<reasoning>\n.*?\n</reasoning>\n<answer>\n.*?\n</answer>\n$")
+SOFT_FORMAT = re.compile(r"<reasoning>.*?</reasoning>\s*<answer>.*?</answer>")
+
+# Print at most one sample completion every this many seconds
+LOG_INTERVAL = 30.0
+
+
+class ParsedCompletion(NamedTuple):
+    """Everything the reward functions need from one completion, extracted in a single pass"""
+    answer: str
+    strict_format: bool
+    soft_format: bool
+    xml_count: float
+
+
+def extract_xml_answer(text: str) -> str:
+    answer = text.split("<answer>")[-1]
+    answer = answer.split("</answer>")[0]
+    return answer.strip()
+
+
+def count_xml(text: str) -> float:
+    count = 0.0
+    if text.count("<reasoning>\n") == 1:
+        count += 0.125
+    if text.count("\n</reasoning>\n") == 1:
+        count += 0.125
+    if text.count("\n<answer>\n") == 1:
+        count += 0.125
+        count -= len(text.split("\n</answer>\n")[-1]) * 0.001
+    if text.count("\n</answer>") == 1:
+        count += 0.125
+        count -= (len(text.split("\n</answer>")[-1]) - 1) * 0.001
+    return count
+
+
+def parse_completion(text: str) -> ParsedCompletion:
+    return ParsedCompletion(
+        answer=extract_xml_answer(text),
+        strict_format=STRICT_FORMAT.match(text) is not None,
+        soft_format=SOFT_FORMAT.match(text) is not None,
+        xml_count=count_xml(text),
+    )
+
+
+class _BatchCache:
+    """
+    GRPOTrainer calls every reward function with the same `completions` list, so
+    the batch is parsed when the first reward function sees it and the other
+    reward functions reuse the result. Identical completions in a group are
+    parsed only once.
+
+    With reward_num_workers > 0 the reward functions run on a thread pool and
+    reach the cache together, so parsing happens under a lock: the first thread
+    parses and the others wait for its result. In process mode every worker
+    receives its own pickled copy of the batch and parses it separately.
+    """
+
+    def __init__(self):
+        # (completions, parsed) swapped as one tuple so lock-free readers never see a mixed pair
+        self.entry = (None, [])
+        self.lock = threading.Lock()
+        self.last_log = 0.0
+
+    def get(self, completions) -> List[ParsedCompletion]:
+        cached_completions, parsed = self.entry
+        if completions is cached_completions:
+            return parsed
+        with self.lock:
+            # Another thread may have parsed this batch while we waited for the lock
+            cached_completions, parsed = self.entry
+            if completions is cached_completions:
+                return parsed
+            by_text: Dict[str, ParsedCompletion] = {}
+            parsed = []
+            for completion in completions:
+                text = completion[0]["content"]
+                if text not in by_text:
+                    by_text[text] = parse_completion(text)
+                parsed.append(by_text[text])
+            self.entry = (completions, parsed)
+            return parsed
+
+    def should_log(self) -> bool:
+        now = time.monotonic()
+        if now - self.last_log < LOG_INTERVAL:
+            return False
+        self.last_log = now
+        return True
+
+
+_batch_cache = _BatchCache()
+
+
+def correctness_reward_func(prompts, completions, answer, **kwargs) -> list[float]:
+    parsed = _batch_cache.get(completions)
+
+    # Debug print, rate-limited so it does not flood the training log on every batch
+    if _batch_cache.should_log():
+        print(
+            '-'*20,
+            f"\nQuestion:\n{prompts[0][-1]['content']}",
+            f"\nGround Truth:\n{answer[0]}",
+            f"\nModel Raw Response:\n{completions[0][0]['content']}",
+            f"\nExtracted Answer:\n{parsed[0].answer}"
+        )
+
+    # Reward = 2.0 if correct label, else 0.0
+    return [2.0 if p.answer == a else 0.0 for p, a in zip(parsed, answer)]
+
+
+def cat_reward_func(completions, **kwargs) -> list[float]:
+    # Reward 0.5 if the model produces *any valid label*, else 0.0
+    return [0.5 if p.answer in VALID_LABELS else 0.0 for p in _batch_cache.get(completions)]
+
+
+def strict_format_reward_func(completions, **kwargs) -> list[float]:
+    """Reward function that checks if the completion has a specific format."""
+    return [0.5 if p.strict_format else 0.0 for p in _batch_cache.get(completions)]
+
+
+def soft_format_reward_func(completions, **kwargs) -> list[float]:
+    """Reward function that checks if the completion has a specific format."""
+    return [0.5 if p.soft_format else 0.0 for p in _batch_cache.get(completions)]
+
+
+def xmlcount_reward_func(completions, **kwargs) -> list[float]:
+    return [p.xml_count for p in _batch_cache.get(completions)]
+
+
+# In the order train_qlora.ipynb passes them to GRPOTrainer
+REWARD_FUNCS = [
+    xmlcount_reward_func,
+    soft_format_reward_func,
+    strict_format_reward_func,
+    cat_reward_func,
+    correctness_reward_func,
+]
@@ -0,0 +1,47 @@
+import html
+import time
+
+
+class StreamRenderer:
+    """
+    Render a token stream into a Streamlit container at a bounded frame rate.
+
+    Each chunk is HTML-escaped once when it arrives and appended to a list
+    buffer, so per-token work is constant. The container is only redrawn when
+    at least 1/fps seconds have passed since the last redraw, which caps the
+    number of websocket messages no matter how fast tokens come in. Call
+    flush() after the stream ends to draw the final state.
+    """
+
+    def __init__(self, container, fps: float = 15, css_class: str = "streaming-text"):
+        self.container = container
+        self.interval = 1.0 / fps
+        self.css_class = css_class
+        self.chunks = []
+        self.escaped_chunks = []
+        self.last_render = 0.0
+        self.dirty = False
+
+    def write(self, text: str):
+        """Buffer one streamed chunk and redraw if the frame interval has elapsed"""
+        self.chunks.append(text)
+        self.escaped_chunks.append(html.escape(text, quote=False))
+        self.dirty = True
+        if time.monotonic() - self.last_render >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Redraw the container with everything buffered so far"""
+        if not self.dirty:
+            return
+        # Collapse the buffer so the next frame only joins what arrived since this one
+        escaped = "".join(self.escaped_chunks)
+        self.escaped_chunks = [escaped]
+        self.container.markdown(f'<div class="{self.css_class}">{escaped}</div>', unsafe_allow_html=True)
+        self.last_render = time.monotonic()
+        self.dirty = False
+
+    @property
+    def text(self) -> str:
+        """The raw (unescaped) text streamed so far"""
+        return "".join(self.chunks)
@@ -0,0 +1,389 @@
+import bisect
+import hashlib
+import json
+import os
+from typing import Dict, Iterator, List, Optional
+
+import torch
+from datasets import Dataset, load_from_disk
+from torch.utils.data import Sampler
+
+
+def format_example(item: Dict) -> str:
+    """Combine input and output into the single text field SFTTrainer trains on"""
+    return f"### Input:\n{item['input']}\n\n### Output:\n{item['output']}"
+
+
+def iter_raw_examples(path: str) -> Iterator[Dict]:
+    """
+    Yield raw {"input", "output"} records from a JSONL, Parquet or JSON file.
+    JSONL and Parquet are read lazily; a .json array still has to be parsed in one go.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".jsonl", ".ndjson"):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    elif ext == ".parquet":
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=4096, columns=["input", "output"]):
+            yield from batch.to_pylist()
+    elif ext == ".json":
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f)
+    else:
+        raise ValueError(f"Unsupported training data format: {path}")
+
+
+def iter_formatted_examples(path: str, size: int, mtime_ns: int) -> Iterator[Dict]:
+    """
+    Generator behind load_training_data. size and mtime_ns are unused here but are
+    part of the generator kwargs, so they are hashed into the Arrow cache fingerprint
+    and an edited data file is re-read instead of served from a stale cache.
+    """
+    for item in iter_raw_examples(path):
+        yield {"text": format_example(item)}
+
+
+def load_training_data(path: str = "training_data.json", cache_dir: Optional[str] = None) -> Dataset:
+    """
+    Load and format training data into a memory-mapped Arrow dataset.
+
+    Examples are formatted one at a time by a generator and written straight to
+    an Arrow cache file, so memory stays flat however large the corpus is, and
+    later runs on the same unchanged file memory-map the cache without re-reading it.
+    """
+    stat = os.stat(path)
+    return Dataset.from_generator(
+        iter_formatted_examples,
+        gen_kwargs={"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+        cache_dir=cache_dir,
+    )
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Hash of everything about a tokenizer that changes the ids it produces"""
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    state = backend.to_str() if backend is not None else json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    special_tokens = json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str)
+    return hashlib.sha256((state + special_tokens).encode("utf-8")).hexdigest()
+
+
+def pretokenize_dataset(dataset: Dataset, tokenizer, max_seq_length: int, add_eos: bool = False,
+                        cache_dir: str = "tokenized_cache", num_proc: Optional[int] = None) -> Dataset:
+    """
+    Tokenize the "text" column into input_ids/attention_mask once and cache the
+    result on disk as memory-mapped Arrow.
+
+    The cache key combines the tokenizer hash, its chat template, max_seq_length,
+    add_eos and the source dataset's fingerprint, so later runs on the same data
+    load the cached ids instantly and SFTTrainer skips its own tokenization.
+    Tokenization runs in a pool of num_proc processes (all cores by default).
+    With add_eos every example ends with EOS, which packing relies on to mark
+    where one example stops.
+    """
+    key = hashlib.sha256(json.dumps({
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "chat_template": getattr(tokenizer, "chat_template", None) or "",
+        "max_seq_length": max_seq_length,
+        "add_eos": add_eos,
+        "dataset": dataset._fingerprint,
+    }, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, key)
+    if os.path.exists(cache_path):
+        return load_from_disk(cache_path)
+
+    eos_token_id = tokenizer.eos_token_id
+    max_length = max_seq_length - 1 if add_eos else max_seq_length
+
+    def _tokenize(batch):
+        encoded = tokenizer(batch["text"], truncation=True, max_length=max_length, return_token_type_ids=False)
+        if add_eos:
+            encoded["input_ids"] = [ids + [eos_token_id] for ids in encoded["input_ids"]]
+            encoded["attention_mask"] = [mask + [1] for mask in encoded["attention_mask"]]
+        return encoded
+
+    tokenized = dataset.map(
+        _tokenize,
+        batched=True,
+        num_proc=num_proc or os.cpu_count(),
+        remove_columns=dataset.column_names,
+        desc="Tokenizing",
+    )
+    # Write to a temporary directory first so an interrupted run never leaves a half-written cache behind
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    tokenized.save_to_disk(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return load_from_disk(cache_path)
+
+
+def pack_sequences(dataset: Dataset, max_seq_length: int) -> Dataset:
+    """
+    Pack tokenized examples into sequences of at most max_seq_length tokens with
+    best-fit decreasing: longest examples first, each into the fullest sequence
+    that still has room. Every packed row keeps "seq_lengths", the lengths of the
+    examples it holds, so the collator can stop them attending to each other.
+    """
+    lengths = dataset.map(
+        lambda batch: {"length": [len(ids) for ids in batch["input_ids"]]},
+        batched=True,
+        remove_columns=dataset.column_names,
+    )["length"]
+    order = sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True)
+
+    # Open sequences sorted by remaining space, so the best fit is a bisect away
+    spaces, bin_ids, bins = [], [], []
+    for index in order:
+        length = lengths[index]
+        position = bisect.bisect_left(spaces, length)
+        if position == len(spaces):
+            bins.append([index])
+            bin_id, space = len(bins) - 1, max_seq_length - length
+        else:
+            bin_id, space = bin_ids.pop(position), spaces.pop(position) - length
+            bins[bin_id].append(index)
+        if space == 0:
+            continue
+        position = bisect.bisect_left(spaces, space)
+        spaces.insert(position, space)
+        bin_ids.insert(position, bin_id)
+
+    rows = dataset.select_columns(["input_ids"])
+
+    def _packed_rows():
+        for members in bins:
+            yield {
+                "input_ids": [token for index in members for token in rows[index]["input_ids"]],
+                "seq_lengths": [lengths[index] for index in members],
+            }
+
+    return Dataset.from_generator(_packed_rows)
+
+
+def packing_efficiency(dataset: Dataset, max_seq_length: int) -> float:
+    """Share of the max_seq_length slots of every sequence that hold real tokens"""
+    real_tokens = sum(sum(seq_lengths) for seq_lengths in dataset["seq_lengths"])
+    return real_tokens / (len(dataset) * max_seq_length)
+
+
+def packed_attention_mode(model) -> str:
+    """
+    Collator attention mode that isolates packed examples for a model. Restarting
+    position_ids only does so under FlashAttention-2's variable-length kernels;
+    SDPA and eager attention need the explicit block-diagonal mask.
+    """
+    implementation = getattr(model.config, "_attn_implementation", None)
+    return "position_ids" if implementation == "flash_attention_2" else "block_diagonal"
+
+
+class PackedSequenceCollator:
+    """
+    Collate packed rows into a batch where packed examples cannot see each other.
+
+    position_ids restart at 0 for every example, which FlashAttention-2 turns into
+    variable-length attention over each example separately. With
+    attention="block_diagonal" (the default) an explicit [batch, 1, seq, seq]
+    additive mask is sent as well, for SDPA and eager attention, which do not read
+    position_ids: 0 where a token may attend (causally, within its own example)
+    and torch.finfo(mask_dtype).min everywhere else, since eager attention adds
+    the mask to the scores as-is. Pass the model's compute dtype as mask_dtype.
+    Use packed_attention_mode(model) to pick the cheaper mode when the model runs
+    FlashAttention-2.
+    The first token of every example is excluded from the loss, since predicting
+    it from the previous example's tokens is meaningless.
+    """
+
+    def __init__(self, pad_token_id: int, attention: str = "block_diagonal", mask_dtype: torch.dtype = torch.float32):
+        if attention not in ("position_ids", "block_diagonal"):
+            raise ValueError(f"Unknown packed attention mode: {attention}")
+        self.pad_token_id = pad_token_id
+        self.attention = attention
+        self.mask_dtype = mask_dtype
+
+    def __call__(self, features):
+        batch_length = max(len(feature["input_ids"]) for feature in features)
+        input_ids, labels, position_ids, masks = [], [], [], []
+        for feature in features:
+            ids = list(feature["input_ids"])
+            seq_lengths = list(feature["seq_lengths"])
+            padding = batch_length - len(ids)
+            if padding:
+                # The padding tail is treated as one more example that is never trained on
+                seq_lengths.append(padding)
+
+            row_labels = ids + [-100] * padding
+            start = 0
+            for length in feature["seq_lengths"]:
+                row_labels[start] = -100
+                start += length
+
+            input_ids.append(ids + [self.pad_token_id] * padding)
+            labels.append(row_labels)
+            position_ids.append([position for length in seq_lengths for position in range(length)])
+            if self.attention == "block_diagonal":
+                allowed = torch.zeros(batch_length, batch_length, dtype=torch.bool)
+                start = 0
+                for length in seq_lengths:
+                    allowed[start:start + length, start:start + length] = torch.ones(length, length, dtype=torch.bool).tril()
+                    start += length
+                mask = torch.full((batch_length, batch_length), torch.finfo(self.mask_dtype).min, dtype=self.mask_dtype)
+                masks.append(mask.masked_fill(allowed, 0))
+
+        batch = {
+            "input_ids": torch.tensor(input_ids, dtype=torch.long),
+            "labels": torch.tensor(labels, dtype=torch.long),
+            "position_ids": torch.tensor(position_ids, dtype=torch.long),
+        }
+        if self.attention == "block_diagonal":
+            batch["attention_mask"] = torch.stack(masks).unsqueeze(1)
+        return batch
+
+
+def compute_token_lengths(dataset: Dataset, tokenizer=None, text_column: str = "text",
+                          prompt_column: str = "prompt", num_proc: int = 1) -> List[int]:
+    """
+    Token length of every example, computed once and cached next to the dataset's Arrow files.
+
+    Uses input_ids when the dataset is already tokenized, otherwise tokenizes the
+    text column, or the chat-templated prompt column for GRPO-style datasets.
+    The cache key covers the tokenizer, its chat template and the columns read,
+    so changing any of them recomputes the lengths.
+    """
+    cache_path = None
+    if dataset.cache_files:
+        key = hashlib.sha256(json.dumps({
+            "dataset": dataset._fingerprint,
+            "tokenizer": tokenizer_fingerprint(tokenizer) if tokenizer is not None else "",
+            "chat_template": getattr(tokenizer, "chat_template", None) or "",
+            "text_column": text_column,
+            "prompt_column": prompt_column,
+        }, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        cache_dir = os.path.dirname(dataset.cache_files[0]["filename"])
+        cache_path = os.path.join(cache_dir, f"lengths-{key}.json")
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                return json.load(f)
+
+    if "input_ids" in dataset.column_names:
+        def _lengths(batch):
+            return {"length": [len(ids) for ids in batch["input_ids"]]}
+    elif text_column in dataset.column_names:
+        def _lengths(batch):
+            return {"length": [len(ids) for ids in tokenizer(batch[text_column])["input_ids"]]}
+    else:
+        def _lengths(batch):
+            return {"length": [
+                len(tokenizer.apply_chat_template(prompt, tokenize=True, add_generation_prompt=True))
+                for prompt in batch[prompt_column]
+            ]}
+
+    lengths = dataset.map(_lengths, batched=True, num_proc=num_proc, remove_columns=dataset.column_names)["length"]
+    if cache_path is not None:
+        with open(cache_path, "w") as f:
+            json.dump(lengths, f)
+    return lengths
+
+
+class LengthGroupedSampler(Sampler):
+    """
+    Sampler that yields batches of examples with similar token lengths.
+
+    Indices are shuffled, split into pools of mega_batch_size batches, and each
+    pool is sorted by (jittered) length before being cut into batches, whose
+    order is shuffled again. Two knobs control the randomness: a larger
+    mega_batch_size groups lengths more tightly, and length_noise multiplies each
+    length by a random factor in [1 - noise, 1 + noise] so batch membership keeps
+    changing between epochs.
+
+    mini_repeat_count and repeat_count follow trl's RepeatSampler: every index is
+    yielded mini_repeat_count times in a row (num_generations for GRPO) and every
+    batch of batch_size unique indices is yielded repeat_count times, so the
+    sampler can stand in for GRPOTrainer's default one.
+
+    The sampler is resumable: the trainer reports every batch it takes through
+    advance(), state_dict() returns the generator state from the start of the
+    current epoch plus the number of indices consumed since, and after
+    load_state_dict() the next epoch rebuilds the same batch order and seeks
+    straight to that position instead of replaying the skipped batches.
+    """
+
+    def __init__(self, lengths: List[int], batch_size: int, mega_batch_size: int = 50,
+                 length_noise: float = 0.1, mini_repeat_count: int = 1, repeat_count: int = 1,
+                 seed: Optional[int] = None):
+        self.lengths = torch.tensor(lengths, dtype=torch.float)
+        self.batch_size = batch_size
+        self.mega_batch_size = mega_batch_size
+        self.length_noise = length_noise
+        self.mini_repeat_count = mini_repeat_count
+        self.repeat_count = repeat_count
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        self.epoch_start_state = self.generator.get_state()
+        self.num_consumed = 0
+        self.resume_offset = 0
+
+    def batches(self) -> List[List[int]]:
+        """One epoch of batches of unique indices, incomplete trailing batch dropped"""
+        num_samples = len(self.lengths)
+        indexes = torch.randperm(num_samples, generator=self.generator)
+        noise = 1 + self.length_noise * (2 * torch.rand(num_samples, generator=self.generator) - 1)
+        jittered = self.lengths * noise
+
+        batches = []
+        pool_size = self.batch_size * self.mega_batch_size
+        for start in range(0, num_samples, pool_size):
+            pool = indexes[start:start + pool_size]
+            pool = pool[torch.argsort(jittered[pool], descending=True)].tolist()
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        batches = [batch for batch in batches if len(batch) == self.batch_size]
+
+        order = torch.randperm(len(batches), generator=self.generator).tolist()
+        return [batches[i] for i in order]
+
+    def __iter__(self):
+        self.epoch_start_state = self.generator.get_state()
+        batches = self.batches()
+        offset, self.resume_offset = self.resume_offset, 0
+        if offset >= len(self):
+            # Saved right at the end of an epoch, so carry on with the next one
+            self.epoch_start_state = self.generator.get_state()
+            batches = self.batches()
+            offset = 0
+        self.num_consumed = offset
+
+        # Whole batches before the saved position are skipped by arithmetic, not by iterating over them
+        first_batch, skip = divmod(offset, self.batch_size * self.mini_repeat_count * self.repeat_count)
+        for batch in batches[first_batch:]:
+            indexes = [index for _ in range(self.repeat_count) for index in batch for _ in range(self.mini_repeat_count)]
+            yield from indexes[skip:]
+            skip = 0
+
+    def advance(self, num_samples: int):
+        """Record that the trainer took num_samples indices of the current epoch"""
+        self.num_consumed += num_samples
+
+    def state_dict(self) -> Dict:
+        return {"generator_state": self.epoch_start_state.tolist(), "num_consumed": self.num_consumed}
+
+    def load_state_dict(self, state: Dict):
+        """Resume from a state_dict(): the next __iter__ replays that epoch's order from the saved position"""
+        self.generator.set_state(torch.tensor(state["generator_state"], dtype=torch.uint8))
+        self.resume_offset = state["num_consumed"]
+
+    def __len__(self) -> int:
+        return (len(self.lengths) // self.batch_size) * self.batch_size * self.mini_repeat_count * self.repeat_count
+
+
+def install_train_sampler(trainer, sampler: Sampler):
+    """
+    Make a Trainer (SFT or GRPO) draw training batches from the given sampler.
+    The trainer saves a resumable sampler's position in its checkpoints and
+    restores it on trainer.train(resume_from_checkpoint=...).
+    """
+    trainer._get_train_sampler = lambda *args, **kwargs: sampler
+    trainer.train_sampler = sampler
+    return trainer
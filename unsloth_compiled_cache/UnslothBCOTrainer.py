@@ -27,10 +27,13 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 from typing import Any, List, Optional, Tuple, Union, Dict, Set, Callable
-from trl.trainer.bco_trainer import (Any, AutoModelForCausalLM, BCOConfig, BCOTrainer, BaseImageProcessor, CLF_NAME, Callable, DPODataCollatorWithPadding, DataCollator, DataLoader, Dataset, EvalLoopOutput, F, FeatureExtractionMixin, Literal, Optional, PartialState, Path, PeftModel, PreTrainedModel, PreTrainedTokenizerBase, ProcessorMixin, RUNNING_NAME, RunningMoments, SequentialSampler, Trainer, TrainerCallback, TrainingArguments, Union, _process_tokens, _tokenize, autocast, contextmanager, create_reference_model, defaultdict, disable_dropout_in_model, generate_model_card, get_comet_experiment_url, has_length, inspect, is_comet_available, is_joblib_available, is_peft_available, is_sklearn_available, is_wandb_available, itemgetter, log_table_to_comet_experiment, logger, logging, maybe_apply_chat_template, maybe_extract_prompt, maybe_unpair_preference_dataset, nn, np, nullcontext, os, pad_to_length, pd, peft_module_casting_to_bf16, prepare_deepspeed, prepare_model_for_kbit_training, random, selective_log_softmax, textwrap, torch, tqdm, F, Optional, PeftModel, PreTrainedModel, Trainer, is_peft_available, logger, os, torch)
+from trl.trainer.bco_trainer import (Any, AutoModelForCausalLM, BCOConfig, BCOTrainer, BaseImageProcessor, CLF_NAME, Callable, DPODataCollatorWithPadding, DataCollator, DataLoader, Dataset, EvalLoopOutput, F, FeatureExtractionMixin, Literal, Optional, PartialState, Path, PeftModel, PreTrainedModel, PreTrainedTokenizerBase, ProcessorMixin, RUNNING_NAME, RunningMoments, SequentialSampler, Trainer, TrainerCallback, TrainingArguments, Union, _process_tokens, _tokenize, autocast, contextmanager, create_reference_model, defaultdict, disable_dropout_in_model, generate_model_card, get_comet_experiment_url, has_length, inspect, is_comet_available, is_joblib_available, is_peft_available, is_sklearn_available, is_wandb_available, itemgetter, log_table_to_comet_experiment, logger, logging, maybe_apply_chat_template, maybe_extract_prompt, maybe_unpair_preference_dataset, nn, np, nullcontext, os, pad_to_length, pd, peft_module_casting_to_bf16, prepare_deepspeed, prepare_model_for_kbit_training, random, textwrap, torch, tqdm, F, Optional, PeftModel, PreTrainedModel, Trainer, is_peft_available, logger, os, torch)
 
 
 import os
+import hashlib
+import json
+import shutil
 from typing import *
 from dataclasses import dataclass, field
 from packaging.version import Version
@@ -40,6 +43,7 @@ from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling as TransformersDataCollatorForLanguageModeling
 from transformers.training_args import ParallelMode
+from datasets import concatenate_datasets, load_from_disk
 
 # Wrap trainer with padding to right and enable training mode
 import functools
@@ -66,22 +70,34 @@ torch_compile_options = {
     "triton.cudagraphs" : False,
 }
 
+# Upper bound on the float32 logits of one chunk in chunked_selective_log_softmax.
+# The chunk count follows from this and the vocab size instead of being fixed.
+SELECTIVE_LOG_SOFTMAX_CHUNK_BYTES = int(os.environ.get("UNSLOTH_LOG_SOFTMAX_CHUNK_MB", "256")) * 1024 * 1024
+
 @torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def chunked_selective_log_softmax(logits, index):
-    # Split into 4 chunks only
-    chunked_logits = torch.chunk(logits.reshape(-1, logits.shape[-1]), chunks = 4, dim = 0)
-    chunked_index  = torch.chunk(index.reshape(-1), chunks = 4, dim = 0)
+def selective_log_softmax_chunk(chunk_logits, chunk_index):
+    # Gather in the input dtype and only upcast the selected values. The float32 cast
+    # below is fused into the logsumexp reduction, so no float32 copy of the chunk is made.
+    selected_logits = torch.gather(chunk_logits, dim = -1, index = chunk_index.unsqueeze(-1)).squeeze(-1)
+    logsumexp_values = torch.logsumexp(chunk_logits.to(torch.float32), dim = -1)
+    return selected_logits.to(torch.float32) - logsumexp_values
+
+def chunked_selective_log_softmax(logits, index, max_chunk_bytes = None):
+    # Same as selective_log_softmax(logits, index), over row chunks whose float32
+    # logits fit in max_chunk_bytes (SELECTIVE_LOG_SOFTMAX_CHUNK_BYTES by default)
+    if max_chunk_bytes is None: max_chunk_bytes = SELECTIVE_LOG_SOFTMAX_CHUNK_BYTES
+    vocab_size = logits.shape[-1]
+    rows_per_chunk = max(1, max_chunk_bytes // (vocab_size * 4))
+    # Round down to a power of two so chunk shapes repeat across calls
+    rows_per_chunk = 1 << (rows_per_chunk.bit_length() - 1)
+    chunked_logits = torch.split(logits.reshape(-1, vocab_size), rows_per_chunk, dim = 0)
+    chunked_index  = torch.split(index.reshape(-1), rows_per_chunk, dim = 0)
     all_per_token_logps = []
-    # Below loop does the same as selective_log_softmax(chunk_logits, chunk_index)
     for chunk_logits, chunk_index in zip(chunked_logits, chunked_index):
-        chunk_logits = chunk_logits.to(torch.float32)
-        selected_logits = torch.gather(chunk_logits, dim = -1, index = chunk_index.unsqueeze(-1)).squeeze(-1)
-        logsumexp_values = torch.logsumexp(chunk_logits, dim = -1)
-        per_token_logps = selected_logits - logsumexp_values
-        all_per_token_logps.append(per_token_logps)
+        all_per_token_logps.append(selective_log_softmax_chunk(chunk_logits, chunk_index))
     pass
     all_per_token_logps = torch.concat(all_per_token_logps)
-    all_per_token_logps = all_per_token_logps.reshape((logits.shape[0], logits.shape[1]))
+    all_per_token_logps = all_per_token_logps.reshape(index.shape)
     return all_per_token_logps
 
 def calculate_pad_tokens_in_prompt(
@@ -139,6 +155,64 @@ def left_pack_padding(tensor: torch.Tensor, pad_id: int) -> torch.Tensor:
     sorted_indices = torch.argsort(mask, dim=1, descending=True, stable=True)
     packed_tensor = torch.gather(tensor, 1, sorted_indices)
     return packed_tensor
+
+# Trainer arguments that change the reference log-probs of an already tokenized dataset
+REF_LOG_PROBS_SETTINGS = (
+    "max_length", "max_prompt_length", "max_completion_length", "truncation_mode",
+    "padding_free", "use_logits_to_keep",
+)
+
+def reference_model_fingerprint(model, ref_adapter_name = None):
+    """
+    Hash of the weights the reference forward pass runs with: the model config plus the
+    name, shape, dtype and a strided sample of every frozen parameter. Trainable (policy
+    adapter) parameters are skipped, so a PEFT model whose adapter is disabled for the
+    reference pass hashes to its base weights.
+    """
+    digest = hashlib.sha256()
+    config = getattr(model, "config", None)
+    if config is not None:
+        digest.update(config.to_json_string().encode("utf-8"))
+    digest.update(str(ref_adapter_name).encode("utf-8"))
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if param.requires_grad: continue
+            digest.update(f"{name}:{tuple(param.shape)}:{param.dtype}".encode("utf-8"))
+            flat = param.reshape(-1)
+            sample = flat[::max(1, flat.numel() // 1024)][:1024]
+            digest.update(sample.float().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+def ref_log_probs_cache_key(dataset, ref_fingerprint, settings):
+    """Cache entry name for a dataset's reference log-probs, or None if the dataset has no fingerprint"""
+    dataset_fingerprint = getattr(dataset, "_fingerprint", None)
+    if dataset_fingerprint is None: return None
+    key = json.dumps([dataset_fingerprint, ref_fingerprint, settings], sort_keys = True, default = str)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+def load_cached_ref_log_probs(cache_dir, cache_key, columns, num_rows):
+    """Memory-mapped reference log-prob columns from an earlier run, or None on a miss"""
+    cache_path = os.path.join(cache_dir, cache_key)
+    if not os.path.isdir(cache_path): return None
+    cached = load_from_disk(cache_path)
+    if cached.num_rows != num_rows or not set(columns).issubset(cached.column_names): return None
+    return cached.select_columns(list(columns))
+
+def save_ref_log_probs(cache_dir, cache_key, values):
+    """Write {column: numpy array} as an Arrow dataset and swap it into place"""
+    cache_path = os.path.join(cache_dir, cache_key)
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    Dataset.from_dict(values).save_to_disk(tmp_path)
+    # A stale entry under the same key (e.g. with a different row count) is replaced
+    if os.path.isdir(cache_path): shutil.rmtree(cache_path)
+    os.replace(tmp_path, cache_path)
+
+def attach_ref_log_probs(dataset, cached):
+    """Add the memory-mapped columns side by side instead of copying them into the dataset"""
+    stale_columns = [column for column in cached.column_names if column in dataset.column_names]
+    if stale_columns: dataset = dataset.remove_columns(stale_columns)
+    return concatenate_datasets([dataset, cached], axis = 1)
+
 @dataclass
 class UnslothBCOConfig(BCOConfig):
     """
@@ -211,6 +285,10 @@ class UnslothBCOConfig(BCOConfig):
         default = None,
         metadata = {'help': 'Maximum sequence length to truncate to.'},
     )
+    ref_log_probs_cache_dir : Optional[str] = field(
+        default = None,
+        metadata = {'help': 'With precompute_ref_log_probs, cache reference log probs here across runs, keyed on the dataset fingerprint and reference model hash.'},
+    )
     def __init__(
         self,
         output_dir = None,
@@ -362,6 +440,7 @@ class UnslothBCOConfig(BCOConfig):
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
         max_seq_length = None,
+        ref_log_probs_cache_dir = None,
         **kwargs,
     ):
         if learning_rate < 1e-7: print(f'Unsloth: Your learning rate of `{learning_rate}` is too small and less than 1e-7! Consider increasing it, otherwise gradient updates will be close to 0!')
@@ -523,6 +602,7 @@ class UnslothBCOConfig(BCOConfig):
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
         self.max_seq_length = max_seq_length
+        self.ref_log_probs_cache_dir = ref_log_probs_cache_dir
 pass
 
 class _UnslothBCOTrainer(Trainer):
@@ -1097,6 +1177,45 @@ class _UnslothBCOTrainer(Trainer):
             if self.ref_adapter_name:
                 self.model.set_adapter(self.model_adapter_name or "default")
 
+    def _attach_precomputed_ref_log_probs(self, dataset, columns, compute_ref_log_probs):
+        """
+        Returns `dataset` with the reference log-prob `columns` added. When
+        `args.ref_log_probs_cache_dir` is set they are loaded memory-mapped from an earlier
+        run on the same dataset and reference weights, and `compute_ref_log_probs` (which
+        returns {column: numpy array}) only runs on a miss.
+        """
+        cache_dir = self.args.ref_log_probs_cache_dir
+        cache_key = None
+        if cache_dir is not None:
+            if self.ref_model is not None:
+                ref_fingerprint = reference_model_fingerprint(self.accelerator.unwrap_model(self.ref_model))
+            else:
+                ref_fingerprint = reference_model_fingerprint(
+                    self.accelerator.unwrap_model(self.model), self.ref_adapter_name
+                )
+            settings = {name: getattr(self.args, name, None) for name in REF_LOG_PROBS_SETTINGS}
+            settings["mixed_precision"] = str(self.accelerator.mixed_precision)
+            settings["columns"] = sorted(columns)
+            cache_key = ref_log_probs_cache_key(dataset, ref_fingerprint, settings)
+
+        if cache_key is not None:
+            cached = load_cached_ref_log_probs(cache_dir, cache_key, columns, len(dataset))
+            if cached is not None:
+                logger.info(f"Unsloth: Loaded cached reference log probs from {os.path.join(cache_dir, cache_key)}")
+                return attach_ref_log_probs(dataset, cached)
+
+        values = compute_ref_log_probs()
+        if cache_key is None:
+            for name, column in values.items():
+                dataset = dataset.add_column(name = name, column = column)
+            return dataset
+
+        if self.accelerator.is_main_process:
+            os.makedirs(cache_dir, exist_ok = True)
+            save_ref_log_probs(cache_dir, cache_key, values)
+        self.accelerator.wait_for_everyone()
+        return attach_ref_log_probs(dataset, load_from_disk(os.path.join(cache_dir, cache_key)))
+
     def get_train_dataloader(self) -> DataLoader:
         """
         Returns the training [`~torch.utils.data.DataLoader`].
@@ -1113,18 +1232,21 @@ class _UnslothBCOTrainer(Trainer):
                 "shuffle": False,
             }
 
-            # prepare dataloader
-            data_loader = self.accelerator.prepare(DataLoader(self.train_dataset, **dataloader_params))
-            reference_completion_logps = []
+            def compute_ref_log_probs():
+                # prepare dataloader
+                data_loader = self.accelerator.prepare(DataLoader(self.train_dataset, **dataloader_params))
+                reference_completion_logps = []
 
-            for padded_batch in tqdm(iterable=data_loader, desc="Train dataset reference log probs"):
-                reference_completion_logp = self.compute_reference_log_probs(padded_batch)
+                for padded_batch in tqdm(iterable=data_loader, desc="Train dataset reference log probs"):
+                    reference_completion_logp = self.compute_reference_log_probs(padded_batch)
 
-                reference_completion_logp = self.accelerator.gather_for_metrics(reference_completion_logp)
-                reference_completion_logps.append(reference_completion_logp.cpu())
+                    reference_completion_logp = self.accelerator.gather_for_metrics(reference_completion_logp)
+                    reference_completion_logps.append(reference_completion_logp.cpu())
 
-            self.train_dataset = self.train_dataset.add_column(
-                name="reference_logps", column=torch.cat(reference_completion_logps).float().numpy()
+                return {"reference_logps": torch.cat(reference_completion_logps).float().numpy()}
+
+            self.train_dataset = self._attach_precomputed_ref_log_probs(
+                self.train_dataset, ["reference_logps"], compute_ref_log_probs
             )
 
             self._precomputed_train_ref_log_probs = True
@@ -1155,19 +1277,22 @@ class _UnslothBCOTrainer(Trainer):
                 "shuffle": False,
             }
 
-            # prepare dataloader
-            data_loader = self.accelerator.prepare(DataLoader(eval_dataset, **dataloader_params))
+            def compute_ref_log_probs():
+                # prepare dataloader
+                data_loader = self.accelerator.prepare(DataLoader(eval_dataset, **dataloader_params))
+
+                reference_completion_logps = []
 
-            reference_completion_logps = []
+                for padded_batch in tqdm(iterable=data_loader, desc="Eval dataset reference log probs"):
+                    reference_completion_logp = self.compute_reference_log_probs(padded_batch)
 
-            for padded_batch in tqdm(iterable=data_loader, desc="Eval dataset reference log probs"):
-                reference_completion_logp = self.compute_reference_log_probs(padded_batch)
+                    reference_completion_logp = self.accelerator.gather_for_metrics(reference_completion_logp)
+                    reference_completion_logps.append(reference_completion_logp.cpu())
 
-                reference_completion_logp = self.accelerator.gather_for_metrics(reference_completion_logp)
-                reference_completion_logps.append(reference_completion_logp.cpu())
+                return {"reference_logps": torch.cat(reference_completion_logps).float().numpy()}
 
-            eval_dataset = eval_dataset.add_column(
-                name="reference_logps", column=torch.cat(reference_completion_logps).float().numpy()
+            eval_dataset = self._attach_precomputed_ref_log_probs(
+                eval_dataset, ["reference_logps"], compute_ref_log_probs
             )
 
             # Save calculated reference_chosen_logps and reference_rejected_logps to the eval_dataset for subsequent runs
@@ -1258,7 +1383,7 @@ class _UnslothBCOTrainer(Trainer):
         # dummy token; we'll ignore the losses on these tokens later
         labels[labels == label_pad_token_id] = 0
 
-        per_token_logps = selective_log_softmax(logits, labels)
+        per_token_logps = chunked_selective_log_softmax(logits, labels)
 
         if average_log_prob:
             return (per_token_logps * loss_mask).sum(-1) / loss_mask.sum(-1)
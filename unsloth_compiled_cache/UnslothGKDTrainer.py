@@ -35,6 +35,7 @@ from typing import *
 from dataclasses import dataclass, field
 from packaging.version import Version
 import torch
+import torch.utils.checkpoint
 import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
@@ -139,6 +140,86 @@ def left_pack_padding(tensor: torch.Tensor, pad_id: int) -> torch.Tensor:
     sorted_indices = torch.argsort(mask, dim=1, descending=True, stable=True)
     packed_tensor = torch.gather(tensor, 1, sorted_indices)
     return packed_tensor
+
+# Upper bound on the vocab-sized intermediates of one sequence block in chunked_generalized_jsd_loss
+GKD_LOSS_CHUNK_BYTES = int(os.environ.get("UNSLOTH_GKD_LOSS_CHUNK_MB", "512")) * 1024 * 1024
+
+def generalized_jsd_per_token(student_logits, teacher_logits, mask, beta, temperature):
+    """
+    Generalized JSD of one sequence block summed over the vocabulary, for the tokens
+    where mask is True (all tokens if mask is None). Same elementwise math as
+    GKDTrainer.generalized_jsd_loss.
+    """
+    if mask is not None:
+        student_logits = student_logits[mask]
+        teacher_logits = teacher_logits[mask]
+
+    # Apply temperature scaling
+    student_logits = student_logits / temperature
+    teacher_logits = teacher_logits / temperature
+
+    student_log_probs = F.log_softmax(student_logits, dim=-1)
+    teacher_log_probs = F.log_softmax(teacher_logits, dim=-1)
+
+    if beta == 0:
+        jsd = F.kl_div(student_log_probs, teacher_log_probs, reduction="none", log_target=True)
+    elif beta == 1:
+        jsd = F.kl_div(teacher_log_probs, student_log_probs, reduction="none", log_target=True)
+    else:
+        beta = torch.tensor(beta, dtype=student_log_probs.dtype)
+        mixture_log_probs = torch.logsumexp(
+            torch.stack([student_log_probs + torch.log(1 - beta), teacher_log_probs + torch.log(beta)]),
+            dim=0,
+        )
+        kl_teacher = F.kl_div(mixture_log_probs, teacher_log_probs, reduction="none", log_target=True)
+        kl_student = F.kl_div(mixture_log_probs, student_log_probs, reduction="none", log_target=True)
+        jsd = beta * kl_teacher + (1 - beta) * kl_student
+    return jsd.sum(dim=-1)
+
+def chunked_generalized_jsd_loss(
+    student_logits, teacher_logits, labels=None, beta=0.5, temperature=1.0, reduction="batchmean", max_chunk_bytes=None
+):
+    """
+    Memory-bounded GKDTrainer.generalized_jsd_loss for the "batchmean", "sum" and "mean"
+    reductions. Streams over blocks of the sequence dimension sized so each block's
+    vocab-sized intermediates fit in max_chunk_bytes (GKD_LOSS_CHUNK_BYTES by default),
+    and checkpoints every block so backward recomputes its log-softmaxes instead of
+    keeping them. Blocks are views of the logits, so nothing vocab-sized outlives a block.
+    """
+    if max_chunk_bytes is None: max_chunk_bytes = GKD_LOSS_CHUNK_BYTES
+    batch_size, seq_len, vocab_size = student_logits.shape
+    # Student and teacher log-probs, the stacked mixture inputs, the mixture and two KL terms
+    bytes_per_token = 8 * vocab_size * student_logits.element_size()
+    block_len = max(1, max_chunk_bytes // (bytes_per_token * batch_size))
+    mask = labels != -100 if labels is not None else None
+
+    total = student_logits.new_zeros((), dtype=torch.float32)
+    for start in range(0, seq_len, block_len):
+        end = min(start + block_len, seq_len)
+        block_mask = mask[:, start:end] if mask is not None else None
+        if block_mask is not None and not block_mask.any(): continue
+        block_jsd = torch.utils.checkpoint.checkpoint(
+            generalized_jsd_per_token,
+            student_logits[:, start:end],
+            teacher_logits[:, start:end],
+            block_mask,
+            beta,
+            temperature,
+            use_reentrant=False,
+        )
+        # Reduce each block in fp32 so precision does not degrade with the number of blocks
+        total = total + block_jsd.float().sum()
+    pass
+
+    num_tokens = mask.sum() if mask is not None else batch_size * seq_len
+    if reduction == "batchmean":
+        loss = total / num_tokens
+    elif reduction == "sum":
+        loss = total
+    else:
+        loss = total / (num_tokens * vocab_size)
+    return loss.to(student_logits.dtype)
+
 @dataclass
 class UnslothGKDConfig(GKDConfig):
     """
@@ -659,6 +740,13 @@ class _UnslothGKDTrainer(SFTTrainer):
             loss: Scalar tensor with the generalized JSD loss
         """
 
+        # Reductions to a scalar stream over sequence blocks instead of materializing every
+        # vocab-sized intermediate for the whole sequence at once
+        if reduction in ("batchmean", "sum", "mean"):
+            return chunked_generalized_jsd_loss(
+                student_logits, teacher_logits, labels=labels, beta=beta, temperature=temperature, reduction=reduction
+            )
+
         # Apply temperature scaling
         student_logits = student_logits / temperature
         teacher_logits = teacher_logits / temperature
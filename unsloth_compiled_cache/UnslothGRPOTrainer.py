@@ -31,6 +31,9 @@ from trl.trainer.grpo_trainer import (Any, AutoConfig, AutoModelForSequenceClass
 
 
 import os
+import json
+import shutil
+import time
 from typing import *
 from dataclasses import dataclass, field
 from packaging.version import Version
@@ -40,9 +43,15 @@ from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling as TransformersDataCollatorForLanguageModeling
 from transformers.training_args import ParallelMode
+from transformers.trainer import OPTIMIZER_NAME, SCALER_NAME, SCHEDULER_NAME, TRAINER_STATE_NAME, TRAINING_ARGS_NAME
+from transformers.trainer_callback import ExportableState
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
 
 # Wrap trainer with padding to right and enable training mode
 import functools
+import concurrent.futures
+import hashlib
+from collections import OrderedDict
 from types import MethodType
 def prepare_for_training_mode(f):
     @functools.wraps(f)
@@ -130,15 +139,106 @@ def create_completion_attention_mask(
 
     return final_mask
 
+def _left_pack_destinations(mask: torch.Tensor):
+    """
+    Destination column of every token when non padding tokens are moved to the front
+    of their row in order, with padding behind them. A single cumsum replaces the
+    O(n log n) stable argsort: a token's slot is the number of tokens before it, and a
+    pad's slot is the row's token count plus the number of pads before it.
+    """
+    non_pad_counts = mask.cumsum(dim=1)
+    num_tokens = non_pad_counts[:, -1:]
+    positions = torch.arange(mask.shape[1], device=mask.device).unsqueeze(0)
+    destinations = torch.where(mask, non_pad_counts - 1, num_tokens + positions - non_pad_counts)
+    return destinations, non_pad_counts, num_tokens, positions
+
 def left_pack_padding(tensor: torch.Tensor, pad_id: int) -> torch.Tensor:
     """
     Moves all padding tokens in each sequence of a batch to the right.
     """
-    mask = (tensor != pad_id)
-    # Must do stable=True since binary mark is unordered
-    sorted_indices = torch.argsort(mask, dim=1, descending=True, stable=True)
-    packed_tensor = torch.gather(tensor, 1, sorted_indices)
+    destinations, _, _, _ = _left_pack_destinations(tensor != pad_id)
+    packed_tensor = torch.empty_like(tensor).scatter_(1, destinations, tensor)
     return packed_tensor
+
+def left_pack_padding_with_completion_mask(
+    input_ids: torch.Tensor,
+    logits_to_keep: int,
+    pad_token_id: int
+):
+    """
+    Fused calculate_pad_tokens_in_prompt + left_pack_padding + create_completion_attention_mask
+    that compares against pad_token_id once. Returns (packed input_ids, attention_mask of the
+    packed ids, completion_input_ids, completion_mask, max_left_pad).
+    """
+    if logits_to_keep >= input_ids.shape[1]:
+        raise ValueError("logits_to_keep must be smaller than the sequence length.")
+
+    mask = input_ids != pad_token_id
+    destinations, non_pad_counts, num_tokens, positions = _left_pack_destinations(mask)
+    packed_input_ids = torch.empty_like(input_ids).scatter_(1, destinations, input_ids)
+    attention_mask = positions < num_tokens
+
+    # Pads in the prompt section = prompt length - tokens counted up to its last column
+    prompt_length = input_ids.shape[1] - logits_to_keep
+    left_pad_tokens_per_prompt = prompt_length - non_pad_counts[:, prompt_length - 1]
+    max_left_pad = left_pad_tokens_per_prompt.max().item()
+
+    completion_length = logits_to_keep + max_left_pad
+    completion_input_ids = packed_input_ids[:, -completion_length:]
+    num_tokens_to_mask = max_left_pad - left_pad_tokens_per_prompt
+    shift_mask = positions[:, :completion_length] >= num_tokens_to_mask.unsqueeze(1)
+    completion_mask = shift_mask & attention_mask[:, -completion_length:]
+
+    return packed_input_ids, attention_mask, completion_input_ids, completion_mask, max_left_pad
+
+def _call_reward_func(reward_func, reward_kwargs):
+    """
+    Runs one Python reward function on a reward pool worker. Module-level so it
+    can be pickled into a ProcessPoolExecutor.
+    """
+    output_reward_func = reward_func(**reward_kwargs)
+    # Convert None values to NaN
+    return [reward if reward is not None else torch.nan for reward in output_reward_func]
+
+class RewardMemo:
+    """
+    LRU memo of per-completion rewards for deterministic, text-only reward
+    functions. Entries are keyed on (reward function, prompt hash, completion
+    hash, hash of the other dataset columns), so byte-identical completions
+    within a group and across steps are scored once.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def hash_value(value):
+        # Prompts and completions are strings or lists of chat messages; repr is stable for both
+        return hashlib.blake2b(repr(value).encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def lookup(self, func_index, row_keys):
+        """
+        Returns (rewards, miss_rows, hits): memoized rewards with None for misses, the first row of every distinct
+        missing key, and how many rows were served without calling the reward function.
+        """
+        rewards, miss_rows, pending = [], [], set()
+        for row, row_key in enumerate(row_keys):
+            key = (func_index, row_key)
+            reward = self.entries.get(key)
+            if reward is not None:
+                self.entries.move_to_end(key)
+            elif key not in pending:
+                pending.add(key)
+                miss_rows.append(row)
+            rewards.append(reward)
+        return rewards, miss_rows, len(row_keys) - len(miss_rows)
+
+    def store(self, func_index, row_keys, rewards):
+        for row_key, reward in zip(row_keys, rewards):
+            self.entries[(func_index, row_key)] = reward
+            self.entries.move_to_end((func_index, row_key))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
 def grpo_compute_loss(
     ref_logits,
     new_logits,
@@ -457,17 +557,11 @@ def grpo_accumulated_loss(
     lm_head = trainer.model.get_output_embeddings().weight
 
     if pixel_values is None: 
-        left_pad_tokens_per_prompt = calculate_pad_tokens_in_prompt(input_ids, logits_to_keep, trainer.processing_class.pad_token_id)
-
-        max_left_pad = max(left_pad_tokens_per_prompt).item()
+        input_ids, packed_attention_mask, completion_input_ids, completion_mask, max_left_pad = \
+            left_pack_padding_with_completion_mask(input_ids, logits_to_keep, trainer.processing_class.pad_token_id)
 
-        input_ids = left_pack_padding(input_ids, trainer.processing_class.pad_token_id)
-
-        completion_input_ids = input_ids[:, -(logits_to_keep +max_left_pad):]
-
-        completion_mask = create_completion_attention_mask(completion_input_ids, left_pad_tokens_per_prompt, max_left_pad, trainer.processing_class.pad_token_id).to(attention_mask.dtype)
-        attention_mask =  input_ids != trainer.processing_class.pad_token_id
-        attention_mask = attention_mask.to(attention_mask.dtype)
+        completion_mask = completion_mask.to(attention_mask.dtype)
+        attention_mask = packed_attention_mask
     else: 
         completion_input_ids = input_ids[:, -logits_to_keep:]
     
@@ -698,6 +792,104 @@ def vLLMSamplingParams(**kwargs):
     sampling_params = SamplingParams(**kwargs)
     sampling_params._set_kwargs = kwargs
     return sampling_params
+
+# Position of a resumable train sampler (one with state_dict/load_state_dict/advance)
+SAMPLER_STATE_NAME = "sampler_state.json"
+
+# Checkpoint files rewritten on every save. The rest (tokenizer, configs, training arguments) rarely change and are
+# shared between checkpoints through hard links when `dedup_checkpoint_files` is set.
+CHECKPOINT_STATE_FILES = (TRAINER_STATE_NAME, OPTIMIZER_NAME, SCHEDULER_NAME, SCALER_NAME, SAMPLER_STATE_NAME)
+
+def is_static_checkpoint_file(name):
+    if name == TRAINING_ARGS_NAME: return True
+    return name not in CHECKPOINT_STATE_FILES and not name.endswith((".safetensors", ".bin", ".pt", ".pth"))
+
+def file_digest(path, chunk_size = 1 << 20):
+    digest = hashlib.blake2b(digest_size = 16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def previous_checkpoint_dir(run_dir, step):
+    """The newest `checkpoint-<n>` directory in `run_dir` with n < step, or None"""
+    pattern = re.compile(rf"{PREFIX_CHECKPOINT_DIR}-(\d+)")
+    steps = [
+        int(match.group(1)) for match in map(pattern.fullmatch, os.listdir(run_dir) if os.path.isdir(run_dir) else [])
+        if match is not None and int(match.group(1)) < step
+    ]
+    return os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{max(steps)}") if steps else None
+
+def link_checkpoint_files(source_dir, target_dir, names):
+    """
+    Hard link `names` from `source_dir` into `target_dir`. Returns False, leaving
+    no partial links behind, if any file is missing or cannot be linked.
+    """
+    if source_dir is None or not names: return False
+    linked = []
+    try:
+        for name in names:
+            os.link(os.path.join(source_dir, name), os.path.join(target_dir, name))
+            linked.append(name)
+    except OSError:
+        # Links share the inode, so a later save must never write through a leftover one
+        for name in linked: os.remove(os.path.join(target_dir, name))
+        return False
+    return True
+
+def link_unchanged_checkpoint_files(checkpoint_dir, previous_dir, previous_digests):
+    """
+    Replace every static file of `checkpoint_dir` that is identical to the same
+    file in `previous_dir` by a hard link to it. `previous_digests` caches the
+    digests of `previous_dir`; the digests of `checkpoint_dir` are returned for
+    the next call. Returns (digests, bytes saved).
+    """
+    digests, saved = {}, 0
+    for name in sorted(os.listdir(checkpoint_dir)):
+        path = os.path.join(checkpoint_dir, name)
+        if not os.path.isfile(path) or not is_static_checkpoint_file(name): continue
+        digests[name] = file_digest(path)
+        previous_path = None if previous_dir is None else os.path.join(previous_dir, name)
+        if previous_path is None or not os.path.isfile(previous_path): continue
+        if os.path.samefile(path, previous_path): continue
+        if (previous_digests.get(name) or file_digest(previous_path)) != digests[name]: continue
+        link_path = f"{path}.link"
+        try:
+            os.link(previous_path, link_path)
+        except OSError:
+            continue  # e.g. a filesystem without hard links
+        saved += os.path.getsize(path)
+        os.replace(link_path, path)
+    return digests, saved
+
+def snapshot_to_cpu(obj, buffers, path = ()):
+    """
+    Copy every tensor of a (nested) state dict to CPU memory. Buffers from the
+    previous checkpoint are reused when the shape and dtype match, and copies
+    from the GPU go to pinned memory without blocking, so the caller must
+    synchronize once after the whole snapshot is taken.
+    """
+    if isinstance(obj, torch.Tensor):
+        buffer = buffers.get(path)
+        if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+            buffer = torch.empty(obj.shape, dtype = obj.dtype, device = "cpu", pin_memory = obj.is_cuda)
+            buffers[path] = buffer
+        buffer.copy_(obj.detach(), non_blocking = obj.is_cuda)
+        return buffer
+    if isinstance(obj, dict):
+        return {key: snapshot_to_cpu(value, buffers, path + (key,)) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)([snapshot_to_cpu(value, buffers, path + (i,)) for i, value in enumerate(obj)])
+    return copy.deepcopy(obj)
+
+class AsyncCheckpointCallback(TrainerCallback):
+    """Waits for the last background checkpoint write when training ends"""
+    def __init__(self, trainer):
+        self.trainer = trainer
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.trainer.wait_for_checkpoint()
+
 @dataclass
 class UnslothGRPOConfig(GRPOConfig):
     """
@@ -919,6 +1111,42 @@ class UnslothGRPOConfig(GRPOConfig):
         default = -1,
         metadata = {'help': 'Chunk size to reduce memory usage. -1 is most efficient.'},
     )
+    reward_num_workers : Optional[int] = field(
+        default = 0,
+        metadata = {'help': 'Number of workers evaluating Python reward functions concurrently, overlapped with the reference log-prob pass. 0 runs them serially.'},
+    )
+    reward_executor : Optional[str] = field(
+        default = 'thread',
+        metadata = {'help': 'Pool used when reward_num_workers > 0: "thread", or "process" for GIL-bound reward functions (must be picklable).'},
+    )
+    stop_strings : Optional[List[str]] = field(
+        default = None,
+        metadata = {'help': 'Strings that finish a completion early. The stop string is kept in the completion and the sequence is treated as ended, like EOS.'},
+    )
+    drop_zero_std_groups : Optional[bool] = field(
+        default = False,
+        metadata = {'help': 'Replace groups whose completions all got the same reward (zero advantage) with fresh groups for recently informative prompts before the loss.'},
+    )
+    informative_prompt_buffer_size : Optional[int] = field(
+        default = 256,
+        metadata = {'help': 'Number of recent prompts with a non-zero reward spread kept to refill dropped groups.'},
+    )
+    reward_cache_size : Optional[int] = field(
+        default = 0,
+        metadata = {'help': 'Entries in the LRU memo of Python reward function outputs, keyed on prompt, completion and dataset columns. 0 disables it.'},
+    )
+    reward_cache_funcs : Optional[List[str]] = field(
+        default = None,
+        metadata = {'help': 'Names of the reward functions to memoize. They must be deterministic and not depend on trainer_state. None memoizes every Python reward function.'},
+    )
+    async_checkpointing : Optional[bool] = field(
+        default = False,
+        metadata = {'help': 'Snapshot checkpoints to pinned CPU memory and write them on a background thread, renaming them into place when complete. Single process only.'},
+    )
+    dedup_checkpoint_files : Optional[bool] = field(
+        default = False,
+        metadata = {'help': 'Hard link the tokenizer, configs and training arguments of a checkpoint to the previous checkpoint when unchanged, instead of storing another copy.'},
+    )
     
     def __init__(
         self,
@@ -1098,6 +1326,15 @@ class UnslothGRPOConfig(GRPOConfig):
         wandb_log_unique_prompts = False,
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
+        reward_num_workers = 0,
+        reward_executor = 'thread',
+        stop_strings = None,
+        drop_zero_std_groups = False,
+        informative_prompt_buffer_size = 256,
+        reward_cache_size = 0,
+        reward_cache_funcs = None,
+        async_checkpointing = False,
+        dedup_checkpoint_files = False,
         
         **kwargs,
     ):
@@ -1132,6 +1369,9 @@ class UnslothGRPOConfig(GRPOConfig):
             print('Unsloth: We now expect `per_device_train_batch_size` to be a multiple of `num_generations`.\nWe will change the batch size of ' + str(per_device_train_batch_size) + ' to the `num_generations` of ' + str(num_generations))
             per_device_train_batch_size = num_generations
         
+        if reward_executor not in ('thread', 'process'):
+            raise ValueError(f'Unsloth: `reward_executor` must be "thread" or "process", got {reward_executor!r}')
+        
         if temperature <= 0:
             raise MathError('Unsloth: Please set a positive non-zero temperature since your results will be wrong.')
         elif temperature >= 10:
@@ -1315,6 +1555,15 @@ class UnslothGRPOConfig(GRPOConfig):
             wandb_log_unique_prompts = wandb_log_unique_prompts,**kwargs)
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
+        self.reward_num_workers = reward_num_workers
+        self.reward_executor = reward_executor
+        self.stop_strings = stop_strings
+        self.drop_zero_std_groups = drop_zero_std_groups
+        self.informative_prompt_buffer_size = informative_prompt_buffer_size
+        self.reward_cache_size = reward_cache_size
+        self.reward_cache_funcs = reward_cache_funcs
+        self.async_checkpointing = async_checkpointing
+        self.dedup_checkpoint_files = dedup_checkpoint_files
         
 pass
 
@@ -1423,6 +1672,23 @@ class _UnslothGRPOTrainer(Trainer):
             else:
                 self.reward_func_names.append(reward_funcs[i].__name__)
         self.reward_funcs = reward_funcs
+        # Created on first use when args.reward_num_workers > 0
+        self._reward_pool = None
+        # Memoized reward functions, by index into reward_funcs
+        self._reward_memo = RewardMemo(args.reward_cache_size) if args.reward_cache_size > 0 else None
+        self._memoized_reward_funcs = set()
+        if self._reward_memo is not None:
+            python_reward_funcs = [
+                name for name, func in zip(self.reward_func_names, reward_funcs) if not isinstance(func, nn.Module)
+            ]
+            cache_funcs = python_reward_funcs if args.reward_cache_funcs is None else args.reward_cache_funcs
+            unknown = set(cache_funcs) - set(python_reward_funcs)
+            if unknown:
+                raise ValueError(
+                    f"Unsloth: `reward_cache_funcs` names {sorted(unknown)}, which are not Python reward functions. "
+                    f"Choose from {python_reward_funcs}."
+                )
+            self._memoized_reward_funcs = {i for i, name in enumerate(self.reward_func_names) if name in cache_funcs}
 
         # Reward weights
         if args.reward_weights is not None:
@@ -1513,6 +1779,10 @@ class _UnslothGRPOTrainer(Trainer):
         # Buffer the batch to reuse generated outputs across multiple updates. For more details, see
         # `_get_train_sampler` and `_prepare_inputs`.
         self._buffered_inputs = None
+        # Recent prompts whose group had a reward spread, used to refill groups dropped by `drop_zero_std_groups`
+        self._informative_prompts = deque(maxlen=args.informative_prompt_buffer_size)
+        # Set while `_refill_zero_std_groups` scores its rollouts, which must not log metrics a second time
+        self._scoring_refill = False
 
         # The trainer estimates the number of FLOPs [floating-point operations] using the number of elements in the
         # input tensor associated with the key "input_ids". However, in GRPO, the sampled data does not include the
@@ -1660,6 +1930,8 @@ class _UnslothGRPOTrainer(Trainer):
                 "repetition_penalty": self.repetition_penalty,
                 "cache_implementation": args.cache_implementation,
             }
+            if args.stop_strings:
+                generation_kwargs["stop_strings"] = args.stop_strings
             if args.use_transformers_paged:
                 generation_kwargs["max_batch_tokens"] = 512
                 generation_kwargs["num_blocks"] = 1024
@@ -1686,6 +1958,17 @@ class _UnslothGRPOTrainer(Trainer):
 
         if args.sync_ref_model:
             self.add_callback(SyncRefModelCallback(ref_model=self.ref_model, accelerator=self.accelerator))
+        # Background checkpoint writer, see _save_checkpoint_async
+        self._checkpoint_writer = None
+        self._checkpoint_future = None
+        self._checkpoint_buffers = {}
+        # (checkpoint directory, {file: digest}) of the last deduplicated checkpoint, see _dedup_checkpoint_files
+        self._checkpoint_digests = (None, {})
+        self._processing_class_files = []
+        # args.ignore_data_skip to restore after resuming with a saved sampler position
+        self._ignore_data_skip = None
+        if getattr(args, "async_checkpointing", False):
+            self.add_callback(AsyncCheckpointCallback(self))
 
         for i, reward_func in enumerate(self.reward_funcs):
             if isinstance(reward_func, PreTrainedModel):
@@ -2012,7 +2295,10 @@ class _UnslothGRPOTrainer(Trainer):
             generate_every = self.args.steps_per_generation * self.num_iterations
             if self._step % generate_every == 0 or self._buffered_inputs is None:
                 # self._buffered_inputs=None can occur when resuming from a checkpoint
+                generation_inputs = generation_batch
                 generation_batch = self._generate_and_score_completions(generation_batch)
+                if "zero_std_mask" in generation_batch:
+                    generation_batch = self._refill_zero_std_groups(generation_inputs, generation_batch)
                 generation_batch = split_pixel_values_by_grid(generation_batch)
 
                 try: generation_batch = shuffle_sequence_dict(generation_batch)
@@ -2031,23 +2317,123 @@ class _UnslothGRPOTrainer(Trainer):
                 self.llm.sleep(os.environ.get('VLLM_SLEEP_MODE', 1))
         return inputs
 
-    @profiling_decorator
-    def _calculate_rewards(self, inputs, prompts, completions, completion_ids_list):
-        device = self.accelerator.device
-        rewards_per_func = torch.zeros(len(prompts), len(self.reward_funcs), device=device)
-
+    def _get_reward_kwargs(self, inputs):
         # Repeat all input columns (but "prompt", "completion", and "completion_ids") to match the num of generations
         keys = [key for key in inputs[0] if key not in ["prompt", "completion", "completion_ids"]]
         reward_kwargs = {key: [example[key] for example in inputs] for key in keys}
 
         # This allows for dynamic reward shaping based on training progress.
         reward_kwargs["trainer_state"] = self.state
+        return reward_kwargs
 
-        for i, (reward_func, reward_processing_class, reward_func_name) in enumerate(
-            zip(self.reward_funcs, self.reward_processing_classes, self.reward_func_names)
-        ):
+    def _get_reward_pool(self):
+        if self._reward_pool is None:
+            if self.args.reward_executor == "process":
+                self._reward_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.args.reward_num_workers)
+            else:
+                self._reward_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.args.reward_num_workers, thread_name_prefix="reward"
+                )
+        return self._reward_pool
+
+    def _reward_func_calls(self, inputs, prompts, completions, completion_ids_list):
+        """
+        Keyword arguments for every Python reward function, as {reward index: (reward_kwargs, memo_state)}. Memoized
+        reward functions only get the rows whose reward is not in the memo, one per distinct key; memo_state is None
+        for the others.
+        """
+        reward_kwargs = self._get_reward_kwargs(inputs)
+        reward_kwargs.update(prompts=prompts, completions=completions, completion_ids=completion_ids_list)
+        python_reward_funcs = [i for i, func in enumerate(self.reward_funcs) if not isinstance(func, nn.Module)]
+        if not self._memoized_reward_funcs:
+            return {i: (reward_kwargs, None) for i in python_reward_funcs}
+
+        # trainer_state is left out of the key: memoized reward functions must not depend on it
+        columns = sorted(
+            key for key in reward_kwargs if key not in ("trainer_state", "prompts", "completions", "completion_ids")
+        )
+        hash_value = self._reward_memo.hash_value
+        row_keys = [
+            (
+                hash_value(prompts[row]),
+                hash_value(completions[row]),
+                hash_value(tuple((key, reward_kwargs[key][row]) for key in columns)),
+            )
+            for row in range(len(prompts))
+        ]
+        calls, subsets = {}, {}
+        for i in python_reward_funcs:
+            if i not in self._memoized_reward_funcs:
+                calls[i] = (reward_kwargs, None)
+                continue
+            rewards, miss_rows, hits = self._reward_memo.lookup(i, row_keys)
+            # Functions missing the same rows share one set of lists, so per-batch caches keyed on identity still hit
+            subset_key = tuple(miss_rows)
+            if subset_key not in subsets:
+                subsets[subset_key] = {
+                    key: value if key == "trainer_state" else [value[row] for row in miss_rows]
+                    for key, value in reward_kwargs.items()
+                }
+            calls[i] = (subsets[subset_key], (row_keys, rewards, miss_rows, hits))
+        return calls
+
+    def _finish_reward_func(self, i, output_reward_func, memo_state):
+        # Store the newly computed rewards and fill them in (including in-batch duplicates) around the memoized ones
+        if memo_state is None:
+            return output_reward_func
+        row_keys, rewards, miss_rows, _ = memo_state
+        miss_keys = [row_keys[row] for row in miss_rows]
+        self._reward_memo.store(i, miss_keys, output_reward_func)
+        computed = dict(zip(miss_keys, output_reward_func))
+        return [computed[row_key] if reward is None else reward for row_key, reward in zip(row_keys, rewards)]
+
+    def _submit_reward_funcs(self, inputs, prompts, completions, completion_ids_list):
+        """
+        Start every Python reward function on the reward pool and return {reward index: (future, memo_state)}, so
+        they run while the caller computes the old/reference log-probs. Returns None when `reward_num_workers` is 0.
+        Model-based rewards need the GPU and stay on the main thread.
+        """
+        if not self.args.reward_num_workers:
+            return None
+        reward_pool = self._get_reward_pool()
+        pending_rewards = {}
+        reward_func_calls = self._reward_func_calls(inputs, prompts, completions, completion_ids_list)
+        for i, (reward_kwargs, memo_state) in reward_func_calls.items():
+            if memo_state is not None and not memo_state[2]:
+                # Every row is memoized, nothing to run
+                future = concurrent.futures.Future()
+                future.set_result([])
+            else:
+                future = reward_pool.submit(_call_reward_func, self.reward_funcs[i], reward_kwargs)
+            pending_rewards[i] = (future, memo_state)
+        return pending_rewards
+
+    @profiling_decorator
+    def _calculate_rewards(self, inputs, prompts, completions, completion_ids_list, pending_rewards=None):
+        device = self.accelerator.device
+        rewards_per_func = torch.zeros(len(prompts), len(self.reward_funcs), device=device)
+
+        if pending_rewards is None:
+            pending_rewards = self._submit_reward_funcs(inputs, prompts, completions, completion_ids_list) or {}
+        reward_kwargs = self._get_reward_kwargs(inputs)
+        reward_func_calls = None
+        memo_hits = {}
+
+        # Model-based rewards first, so the pooled reward functions keep running while they are scored
+        order = sorted(range(len(self.reward_funcs)), key=lambda i: i in pending_rewards)
+        for i in order:
+            reward_func = self.reward_funcs[i]
+            reward_processing_class = self.reward_processing_classes[i]
+            reward_func_name = self.reward_func_names[i]
             with profiling_context(self, reward_func_name):
-                if isinstance(reward_func, nn.Module):  # Module (no PretrainedModel) for compat with compiled models
+                if i in pending_rewards:
+                    # Already running on the reward pool, so this only times the remaining wait
+                    future, memo_state = pending_rewards[i]
+                    output_reward_func = self._finish_reward_func(i, future.result(), memo_state)
+                    rewards_per_func[:, i] = torch.tensor(output_reward_func, dtype=torch.float32, device=device)
+                    if memo_state is not None:
+                        memo_hits[i] = memo_state[3]
+                elif isinstance(reward_func, nn.Module):  # Module (no PretrainedModel) for compat with compiled models
                     if is_conversational(inputs[0]):
                         messages = [{"messages": p + c} for p, c in zip(prompts, completions)]
                         texts = [apply_chat_template(x, reward_processing_class)["text"] for x in messages]
@@ -2060,13 +2446,17 @@ class _UnslothGRPOTrainer(Trainer):
                     with torch.inference_mode():
                         rewards_per_func[:, i] = reward_func(**reward_inputs).logits[:, 0]  # Shape (B*G,)
                 else:
-                    output_reward_func = reward_func(
-                        prompts=prompts, completions=completions, completion_ids=completion_ids_list, **reward_kwargs
-                    )
-                    # Convert None values to NaN
-                    output_reward_func = [reward if reward is not None else torch.nan for reward in output_reward_func]
-
+                    if reward_func_calls is None:
+                        reward_func_calls = self._reward_func_calls(inputs, prompts, completions, completion_ids_list)
+                    call_kwargs, memo_state = reward_func_calls[i]
+                    if memo_state is not None and not memo_state[2]:
+                        output_reward_func = []  # Every row is memoized
+                    else:
+                        output_reward_func = _call_reward_func(reward_func, call_kwargs)
+                    output_reward_func = self._finish_reward_func(i, output_reward_func, memo_state)
                     rewards_per_func[:, i] = torch.tensor(output_reward_func, dtype=torch.float32, device=device)
+                    if memo_state is not None:
+                        memo_hits[i] = memo_state[3]
 
         # If all reward functions return None for a given row, issue a detailed warning
         if torch.isnan(rewards_per_func).all(dim=1).any():
@@ -2081,11 +2471,49 @@ class _UnslothGRPOTrainer(Trainer):
                 "Please ensure that at least one reward function returns a valid reward."
             )
 
+        if self._memoized_reward_funcs:
+            # Fraction of rows per memoized reward function that did not need a call, across processes
+            memoized = sorted(self._memoized_reward_funcs)
+            hits = gather(torch.tensor([[memo_hits[i] for i in memoized]], dtype=torch.float32, device=device))
+            num_rows = gather(torch.tensor([len(prompts)], dtype=torch.float32, device=device)).sum()
+            mode = "train" if self.model.training else "eval"
+            for i, func_hits in zip(memoized, hits.sum(dim=0).tolist()):
+                self._metrics[mode][f"reward_cache/{self.reward_func_names[i]}/hit_rate"].append(func_hits / num_rows.item())
+            self._metrics[mode]["reward_cache/size"].append(len(self._reward_memo.entries))
+
         # Gather the reward per function: this part is crucial, because the rewards are normalized per group and the
         # completions may be distributed across processes
         rewards_per_func = gather(rewards_per_func)
         return rewards_per_func
 
+    def _stop_strings_tokenizer(self):
+        # generate() needs the tokenizer to match stop strings across token boundaries
+        if not self.args.stop_strings:
+            return None
+        return getattr(self.processing_class, "tokenizer", self.processing_class)
+
+    def _vllm_generation_kwargs(self):
+        generation_kwargs = dict(self.args.generation_kwargs or {})
+        if self.args.stop_strings:
+            # Keep the stop string so reward functions see e.g. the closing tag they check for
+            generation_kwargs.setdefault("stop", self.args.stop_strings)
+            generation_kwargs.setdefault("include_stop_str_in_output", True)
+        return generation_kwargs or None
+
+    def _stop_string_ends(self, completion_ids):
+        """
+        Marks the last token of completions that finished on a stop string. Finished sequences are followed only by
+        padding (transformers pads them until the whole batch is done, vLLM outputs are right padded), so a row with
+        trailing padding ended at the token before it.
+        """
+        is_pad = completion_ids == self.pad_token_id
+        trailing_pad = is_pad.flip(dims=[1]).int().cumprod(dim=1).sum(dim=1)
+        end_idx = completion_ids.size(1) - trailing_pad - 1
+        stopped = (trailing_pad > 0) & (end_idx >= 0)
+        ends = torch.zeros_like(is_pad)
+        ends[stopped.nonzero(as_tuple=True)[0], end_idx[stopped]] = True
+        return ends
+
     def _generate_and_score_completions(
         self, inputs: list[dict[str, Union[torch.Tensor, Any]]]
     ) -> dict[str, Union[torch.Tensor, Any]]:
@@ -2179,7 +2607,7 @@ class _UnslothGRPOTrainer(Trainer):
                             min_p=0.0 if self.min_p is None else self.min_p,
                             max_tokens=self.max_completion_length,
                             guided_decoding_regex=self.guided_decoding_regex,
-                            generation_kwargs=self.args.generation_kwargs,
+                            generation_kwargs=self._vllm_generation_kwargs(),
                         )
                 else:
                     completion_ids = [None] * len(all_prompts_text)
@@ -2209,8 +2637,7 @@ class _UnslothGRPOTrainer(Trainer):
                     "max_tokens": self.max_completion_length,
                     "guided_decoding": guided_decoding,
                 }
-                if self.args.generation_kwargs is not None:
-                    generation_kwargs.update(self.args.generation_kwargs)
+                generation_kwargs.update(self._vllm_generation_kwargs() or {})
                 sampling_params = SamplingParams(**generation_kwargs)
 
                 if self.vllm_tensor_parallel_size > 1:
@@ -2305,7 +2732,10 @@ class _UnslothGRPOTrainer(Trainer):
             ):
                 prompt_inputs["input_ids"], prompt_inputs["attention_mask"] = prompt_ids, prompt_mask
                 prompt_completion_ids = unwrapped_model.generate(
-                    **prompt_inputs, generation_config=self.generation_config, disable_compile=True
+                    **prompt_inputs,
+                    generation_config=self.generation_config,
+                    disable_compile=True,
+                    tokenizer=self._stop_strings_tokenizer(),
                 )
             # Compute prompt length and extract completion ids
             prompt_length = prompt_ids.size(1)
@@ -2314,6 +2744,9 @@ class _UnslothGRPOTrainer(Trainer):
 
         # Mask everything after the first EOS token
         is_eos = completion_ids == self.eos_token_id
+        if self.args.stop_strings:
+            # A completion cut by a stop string ends like one that emitted EOS
+            is_eos = is_eos | self._stop_string_ends(completion_ids)
         eos_idx = torch.full((is_eos.size(0),), is_eos.size(1), dtype=torch.long, device=device)
         eos_idx[is_eos.any(dim=1)] = is_eos.int().argmax(dim=1)[is_eos.any(dim=1)]
         sequence_indices = torch.arange(is_eos.size(1), device=device).expand(is_eos.size(0), -1)
@@ -2343,6 +2776,19 @@ class _UnslothGRPOTrainer(Trainer):
             # Left pad prompt before calculation old and ref hidden states
             prompt_completion_ids = left_pack_padding(prompt_completion_ids, self.processing_class.pad_token_id)
 
+        # Decode the generated completions
+        completions_text = self.processing_class.batch_decode(completion_ids, skip_special_tokens=True)
+        if is_conversational(inputs[0]):
+            completions = []
+            for prompt, completion in zip(prompts, completions_text):
+                bootstrap = prompt.pop()["content"] if prompt[-1]["role"] == "assistant" else ""
+                completions.append([{"role": "assistant", "content": bootstrap + completion}])
+        else:
+            completions = completions_text
+
+        # Start the Python reward functions now so they overlap with the old/ref log-prob forward passes below
+        pending_rewards = self._submit_reward_funcs(inputs, original_prompts, completions, completion_ids_list)
+
         with torch.no_grad():
             # If the generation and optimization steps are misaligned—i.e., if generation does not occur at the end of
             # a full optimizer step (when gradient_accumulation_steps is not a multiple of generate_every)—then the
@@ -2395,20 +2841,12 @@ class _UnslothGRPOTrainer(Trainer):
             else:
                 ref_per_token_logps = None
 
-        # Decode the generated completions
-        completions_text = self.processing_class.batch_decode(completion_ids, skip_special_tokens=True)
-        if is_conversational(inputs[0]):
-            completions = []
-            for prompt, completion in zip(prompts, completions_text):
-                bootstrap = prompt.pop()["content"] if prompt[-1]["role"] == "assistant" else ""
-                completions.append([{"role": "assistant", "content": bootstrap + completion}])
-        else:
-            completions = completions_text
-
         # Calculate rewards for each reward function. rewards_per_func aggregates rewards across all processes. This is
         # important because rewards will be normalized per group, and completions are distributed. We will later slice
         # rewards_per_func to extract each process's subset.
-        rewards_per_func = self._calculate_rewards(inputs, original_prompts, completions, completion_ids_list)
+        rewards_per_func = self._calculate_rewards(
+            inputs, original_prompts, completions, completion_ids_list, pending_rewards
+        )
 
         # Apply weights to each reward function's output and sum
         rewards = (rewards_per_func * self.reward_weights.to(device).unsqueeze(0)).nansum(dim=1)
@@ -2444,46 +2882,48 @@ class _UnslothGRPOTrainer(Trainer):
         all_process_advantages = advantages.clone()  # keep the aggregated advantages for logging
         advantages = advantages[process_slice]
 
-        # Log the metrics
-        if mode == "train":
-            self.state.num_input_tokens_seen += self.accelerator.gather(attention_mask.sum()).sum().item()
-        self._metrics[mode]["num_tokens"] = [self.state.num_input_tokens_seen]
-
-        # Log completion lengths, mean, min, max
-        self._metrics[mode]["completions/mean_length"].append(agg_completion_lengths.float().mean().item())
-        self._metrics[mode]["completions/min_length"].append(agg_completion_lengths.float().min().item())
-        self._metrics[mode]["completions/max_length"].append(agg_completion_lengths.float().max().item())
-
-        # Identify sequences that terminated with EOS and log their lengths
-        agg_terminated_with_eos = self.accelerator.gather(is_eos.any(dim=1))
-        term_completion_lengths = agg_completion_lengths[agg_terminated_with_eos]
-        clipped_completions_ratio = 1 - len(term_completion_lengths) / len(agg_completion_lengths)
-        self._metrics[mode]["completions/clipped_ratio"].append(clipped_completions_ratio)
-        if len(term_completion_lengths) == 0:  # edge case where no terminated sequences are found
-            term_completion_lengths = torch.zeros(1, device=device)
-        self._metrics[mode]["completions/mean_terminated_length"].append(term_completion_lengths.float().mean().item())
-        self._metrics[mode]["completions/min_terminated_length"].append(term_completion_lengths.float().min().item())
-        self._metrics[mode]["completions/max_terminated_length"].append(term_completion_lengths.float().max().item())
-
-        # Calculate mean reward per function, but only for samples where the function was applied (non-NaN values)
-        for i, reward_func_name in enumerate(self.reward_func_names):
-            mean_rewards = torch.nanmean(rewards_per_func[:, i]).item()
-            self._metrics[mode][f"rewards/{reward_func_name}/mean"].append(mean_rewards)
-            std_func_rewards = nanstd(rewards_per_func[:, i]).item()
-            self._metrics[mode][f"rewards/{reward_func_name}/std"].append(std_func_rewards)
-        self._metrics[mode]["reward"].append(mean_grouped_rewards.mean().item())
-        self._metrics[mode]["reward_std"].append(std_rewards.mean().item())
-        self._metrics[mode]["frac_reward_zero_std"].append(is_std_zero.float().mean().item())
-
-        # Log prompt and completion texts
-        self._logs["prompt"].extend(gather_object(prompts_text))
-        self._logs["completion"].extend(gather_object(completions_text))
-        for i, name in enumerate(self.reward_func_names):
-            self._logs["rewards"][name].extend(rewards_per_func[:, i].tolist())
-        self._logs["advantages"].extend(all_process_advantages.tolist())
-
-        if has_images:
-            self._logs["image"].extend(gather_object(images))
+        # Log the metrics. Refill rollouts are skipped: the batch they complete was already logged, and
+        # `_refill_zero_std_groups` corrects the token count for the groups it swaps in
+        if not self._scoring_refill:
+            if mode == "train":
+                self.state.num_input_tokens_seen += self.accelerator.gather(attention_mask.sum()).sum().item()
+            self._metrics[mode]["num_tokens"] = [self.state.num_input_tokens_seen]
+
+            # Log completion lengths, mean, min, max
+            self._metrics[mode]["completions/mean_length"].append(agg_completion_lengths.float().mean().item())
+            self._metrics[mode]["completions/min_length"].append(agg_completion_lengths.float().min().item())
+            self._metrics[mode]["completions/max_length"].append(agg_completion_lengths.float().max().item())
+
+            # Identify sequences that terminated with EOS and log their lengths
+            agg_terminated_with_eos = self.accelerator.gather(is_eos.any(dim=1))
+            term_completion_lengths = agg_completion_lengths[agg_terminated_with_eos]
+            clipped_completions_ratio = 1 - len(term_completion_lengths) / len(agg_completion_lengths)
+            self._metrics[mode]["completions/clipped_ratio"].append(clipped_completions_ratio)
+            if len(term_completion_lengths) == 0:  # edge case where no terminated sequences are found
+                term_completion_lengths = torch.zeros(1, device=device)
+            self._metrics[mode]["completions/mean_terminated_length"].append(term_completion_lengths.float().mean().item())
+            self._metrics[mode]["completions/min_terminated_length"].append(term_completion_lengths.float().min().item())
+            self._metrics[mode]["completions/max_terminated_length"].append(term_completion_lengths.float().max().item())
+
+            # Calculate mean reward per function, but only for samples where the function was applied (non-NaN values)
+            for i, reward_func_name in enumerate(self.reward_func_names):
+                mean_rewards = torch.nanmean(rewards_per_func[:, i]).item()
+                self._metrics[mode][f"rewards/{reward_func_name}/mean"].append(mean_rewards)
+                std_func_rewards = nanstd(rewards_per_func[:, i]).item()
+                self._metrics[mode][f"rewards/{reward_func_name}/std"].append(std_func_rewards)
+            self._metrics[mode]["reward"].append(mean_grouped_rewards.mean().item())
+            self._metrics[mode]["reward_std"].append(std_rewards.mean().item())
+            self._metrics[mode]["frac_reward_zero_std"].append(is_std_zero.float().mean().item())
+
+            # Log prompt and completion texts
+            self._logs["prompt"].extend(gather_object(prompts_text))
+            self._logs["completion"].extend(gather_object(completions_text))
+            for i, name in enumerate(self.reward_func_names):
+                self._logs["rewards"][name].extend(rewards_per_func[:, i].tolist())
+            self._logs["advantages"].extend(all_process_advantages.tolist())
+
+            if has_images:
+                self._logs["image"].extend(gather_object(images))
 
         output = {
             "prompt_ids": prompt_ids,
@@ -2505,8 +2945,98 @@ class _UnslothGRPOTrainer(Trainer):
             output["pixel_attention_mask"] = prompt_inputs["pixel_attention_mask"]
         if "image_sizes" in prompt_inputs:
             output["image_sizes"] = prompt_inputs["image_sizes"]
+        if self.args.drop_zero_std_groups and mode == "train" and not has_images and len(prompts) % self.num_generations == 0:
+            # Groups where every completion got the same reward, whatever scale_rewards is
+            group_std = rewards.view(-1, self.num_generations).std(dim=1)
+            zero_std_mask = torch.isclose(group_std, torch.zeros_like(group_std)).repeat_interleave(self.num_generations)
+            output["zero_std_mask"] = zero_std_mask[process_slice]
         return output
 
+    def _concat_generation_batches(self, first, second):
+        # Concatenate two scored batches whose prompts are left padded and completions right padded to different lengths
+        def concat(key, padding_value, padding_side):
+            a, b = first[key], second[key]
+            length = max(a.size(1), b.size(1))
+            padded = []
+            for tensor in (a, b):
+                extra = length - tensor.size(1)
+                padding = (extra, 0) if padding_side == "left" else (0, extra)
+                padded.append(F.pad(tensor, padding, value=padding_value))
+            return torch.cat(padded, dim=0)
+
+        merged = {
+            "prompt_ids": concat("prompt_ids", self.pad_token_id, "left"),
+            "prompt_mask": concat("prompt_mask", 0, "left"),
+            "completion_ids": concat("completion_ids", self.pad_token_id, "right"),
+            "completion_mask": concat("completion_mask", 0, "right"),
+            "advantages": torch.cat([first["advantages"], second["advantages"]]),
+        }
+        for key in ("old_per_token_logps", "ref_per_token_logps"):
+            if key in first:
+                merged[key] = concat(key, 0.0, "right")
+        return merged
+
+    def _refill_zero_std_groups(self, generation_inputs, batch):
+        """
+        Groups whose completions all got the same reward have zero advantage, so in the loss they only add the KL
+        term. Drop them and generate fresh groups for prompts that recently produced a reward spread, keeping the
+        generation batch size fixed. If there are not enough informative groups, dropped groups are put back as
+        filler. Every process refills the same number of groups, since generation and scoring use collectives.
+        """
+        device = self.accelerator.device
+        num_generations = self.num_generations
+        zero_std_groups = batch.pop("zero_std_mask").view(-1, num_generations)[:, 0]
+        num_groups = zero_std_groups.numel()
+
+        for group, is_zero_std in enumerate(zero_std_groups.tolist()):
+            if not is_zero_std:
+                self._informative_prompts.append(generation_inputs[group * num_generations])
+
+        local_state = torch.tensor([int(zero_std_groups.sum()), int(len(self._informative_prompts) > 0)], device=device)
+        global_state = self.accelerator.gather(local_state.unsqueeze(0))
+        num_refill = int(global_state[:, 0].max()) if bool(global_state[:, 1].all()) else 0
+
+        if num_refill == 0:
+            self._metrics["train"]["zero_std_groups/filtered_frac"].append(0.0)
+            self._metrics["train"]["zero_std_groups/refill_groups"].append(0)
+            return batch
+
+        picks = torch.randint(len(self._informative_prompts), (num_refill,)).tolist()
+        refill_inputs = [copy.deepcopy(self._informative_prompts[i]) for i in picks for _ in range(num_generations)]
+        self._scoring_refill = True
+        try:
+            refill = self._generate_and_score_completions(refill_inputs)
+        finally:
+            self._scoring_refill = False
+        refill_zero_std_groups = refill.pop("zero_std_mask").view(-1, num_generations)[:, 0]
+        merged = self._concat_generation_batches(batch, refill)
+
+        # Informative groups first (this batch, then refills), dropped groups only as filler
+        is_zero_std = torch.cat([zero_std_groups, refill_zero_std_groups]).tolist()
+        informative = [group for group, zero in enumerate(is_zero_std) if not zero]
+        filler = [group for group in range(num_groups) if is_zero_std[group]]
+        groups = (informative + filler)[:num_groups]
+        num_replaced = sum(1 for group in groups if group >= num_groups)
+
+        rows = torch.tensor(
+            [group * num_generations + i for group in groups for i in range(num_generations)], device=device
+        )
+        refilled = {key: value[rows] for key, value in merged.items()}
+        # Number of completion tokens across processes, as used by the DAPO loss
+        refilled["num_items_in_batch"] = self.accelerator.gather(refilled["completion_mask"].sum()).sum()
+
+        # The original batch was counted when it was scored; swap the dropped groups' tokens for the refills'
+        def num_tokens(rows_batch):
+            return rows_batch["prompt_mask"].sum() + rows_batch["completion_mask"].sum()
+        token_delta = self.accelerator.gather((num_tokens(refilled) - num_tokens(batch)).unsqueeze(0)).sum().item()
+        self.state.num_input_tokens_seen += token_delta
+        self._metrics["train"]["num_tokens"] = [self.state.num_input_tokens_seen]
+
+        replaced = self.accelerator.gather(torch.tensor([[num_replaced, num_groups]], device=device)).sum(dim=0)
+        self._metrics["train"]["zero_std_groups/filtered_frac"].append((replaced[0] / replaced[1]).item())
+        self._metrics["train"]["zero_std_groups/refill_groups"].append(num_refill)
+        return refilled
+
     def compute_liger_loss(self, unwrapped_model, inputs):
         # Compute the per-token log probabilities for the model
         prompt_ids, prompt_mask = inputs["prompt_ids"], inputs["prompt_mask"]
@@ -2872,7 +3402,173 @@ class _UnslothGRPOTrainer(Trainer):
         else:
             model_name = self.args.hub_model_id.split("/")[-1]
         self.create_model_card(model_name=model_name)
+        if self._use_async_checkpointing():
+            self._save_checkpoint_async(model, trial)
+            return
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+        dedup = getattr(self.args, "dedup_checkpoint_files", False) and self.args.should_save
+        if dedup and os.path.isdir(output_dir):
+            # Its files may be hard links into an older checkpoint, which the save below would write through
+            shutil.rmtree(output_dir)
+        previous_dir = previous_checkpoint_dir(run_dir, self.state.global_step) if dedup else None
         super()._save_checkpoint(model, trial)
+        if self.args.should_save:
+            self._save_sampler_state(output_dir)
+        if dedup:
+            saved = self._dedup_checkpoint_files(output_dir, previous_dir, output_dir)
+            self._metrics["train"]["checkpoint/dedup_bytes"].append(saved)
+
+    def _use_async_checkpointing(self):
+        # Sharded and multi-process saves, Hub pushes and best model tracking keep the synchronous path
+        args = self.args
+        return (
+            getattr(args, "async_checkpointing", False)
+            and args.world_size == 1
+            and not self.is_deepspeed_enabled
+            and not self.is_fsdp_enabled
+            and not args.push_to_hub
+            and args.metric_for_best_model is None
+            and hasattr(self.accelerator.unwrap_model(self.model), "save_pretrained")
+        )
+
+    def _save_checkpoint_async(self, model, trial):
+        """
+        Copies the weights and optimizer state to pinned CPU buffers and writes the checkpoint on a background thread,
+        so training continues as soon as the device-to-host copies finish. Files go to a hidden staging directory
+        that is renamed to `checkpoint-<step>` once complete, and older checkpoints are only rotated out after that,
+        so a crash mid-write never leaves a partial checkpoint behind.
+        """
+        start = time.perf_counter()
+        # The previous write still reads the pinned buffers this snapshot reuses
+        saved = self.wait_for_checkpoint()
+        if saved is not None:
+            # Metrics are only touched from the training thread
+            self._metrics["train"]["checkpoint/dedup_bytes"].append(saved)
+
+        checkpoint_folder = f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}"
+        if self.hp_search_backend is None and trial is None:
+            self.store_flos()
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, checkpoint_folder)
+        staging_dir = os.path.join(run_dir, f".{checkpoint_folder}.tmp")
+        if os.path.isdir(staging_dir):
+            shutil.rmtree(staging_dir)
+        os.makedirs(staging_dir)
+
+        unwrapped_model = self.accelerator.unwrap_model(model)
+        if hasattr(unwrapped_model, "peft_config"):
+            # PEFT only saves the adapter, so only the trainable parameters need copying
+            model_state = {name: param for name, param in unwrapped_model.named_parameters() if param.requires_grad}
+        else:
+            model_state = unwrapped_model.state_dict()
+        buffers = self._checkpoint_buffers
+        model_state = snapshot_to_cpu(model_state, buffers, ("model",))
+        optimizer_state = scheduler_state = scaler_state = None
+        if not self.args.save_only_model:
+            optimizer_state = snapshot_to_cpu(self.optimizer.state_dict(), buffers, ("optimizer",))
+            scheduler_state = copy.deepcopy(self.lr_scheduler.state_dict())
+            if self.accelerator.scaler is not None:
+                scaler_state = copy.deepcopy(self.accelerator.scaler.state_dict())
+            self._save_rng_state(staging_dir)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        # Small files are written now so they match this step exactly
+        for cb in [cb for cb in self.callback_handler.callbacks + [self.control] if isinstance(cb, ExportableState)]:
+            cb_name = cb.__class__.__name__
+            cb_state = cb.state()
+            if isinstance(self.state.stateful_callbacks[cb_name], list):
+                self.state.stateful_callbacks[cb_name].append(cb_state)
+            else:
+                self.state.stateful_callbacks[cb_name] = cb_state
+        self.state.save_to_json(os.path.join(staging_dir, TRAINER_STATE_NAME))
+        torch.save(self.args, os.path.join(staging_dir, TRAINING_ARGS_NAME))
+        self._save_sampler_state(staging_dir)
+        dedup = getattr(self.args, "dedup_checkpoint_files", False)
+        previous_dir = previous_checkpoint_dir(run_dir, self.state.global_step) if dedup else None
+
+        def write_checkpoint():
+            unwrapped_model.save_pretrained(
+                staging_dir, state_dict=model_state, safe_serialization=self.args.save_safetensors
+            )
+            # The tokenizer does not change during training, so after the first save its files are linked instead
+            if self.processing_class is not None and not (
+                dedup and link_checkpoint_files(previous_dir, staging_dir, self._processing_class_files)
+            ):
+                existing = set(os.listdir(staging_dir))
+                self.processing_class.save_pretrained(staging_dir)
+                self._processing_class_files = sorted(set(os.listdir(staging_dir)) - existing)
+            if optimizer_state is not None:
+                torch.save(optimizer_state, os.path.join(staging_dir, OPTIMIZER_NAME))
+                torch.save(scheduler_state, os.path.join(staging_dir, SCHEDULER_NAME))
+            if scaler_state is not None:
+                torch.save(scaler_state, os.path.join(staging_dir, SCALER_NAME))
+            saved = self._dedup_checkpoint_files(staging_dir, previous_dir, output_dir) if dedup else None
+            if os.path.isdir(output_dir):
+                shutil.rmtree(output_dir)
+            os.replace(staging_dir, output_dir)
+            self._rotate_checkpoints(use_mtime=False, output_dir=run_dir)
+            return saved
+
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="checkpoint"
+            )
+        self._checkpoint_future = self._checkpoint_writer.submit(write_checkpoint)
+        self._metrics["train"]["checkpoint/save_stall_seconds"].append(time.perf_counter() - start)
+
+    def _resumable_sampler(self):
+        # Set by training_data.install_train_sampler; the default samplers keep the Trainer's batch skipping
+        sampler = getattr(self, "train_sampler", None)
+        return sampler if hasattr(sampler, "load_state_dict") else None
+
+    def _save_sampler_state(self, output_dir):
+        sampler = self._resumable_sampler()
+        if sampler is None:
+            return
+        with open(os.path.join(output_dir, SAMPLER_STATE_NAME), "w") as file:
+            json.dump(sampler.state_dict(), file)
+
+    def _load_from_checkpoint(self, resume_from_checkpoint, model=None):
+        super()._load_from_checkpoint(resume_from_checkpoint, model)
+        sampler = self._resumable_sampler()
+        state_path = os.path.join(resume_from_checkpoint, SAMPLER_STATE_NAME)
+        if sampler is None or not os.path.isfile(state_path):
+            return
+        with open(state_path) as file:
+            sampler.load_state_dict(json.load(file))
+        # The sampler seeks to the saved position itself, so the Trainer must not replay batches to get there. The
+        # flag is read once when the training loop starts and restored on the first batch. With a delayed optimizer
+        # (FSDP/DeepSpeed) this runs twice before that, so only the user's value is stashed, never the forced True.
+        if self._ignore_data_skip is None:
+            self._ignore_data_skip = self.args.ignore_data_skip
+        self.args.ignore_data_skip = True
+
+    def get_batch_samples(self, epoch_iterator, num_batches, device):
+        batch_samples, num_items_in_batch = super().get_batch_samples(epoch_iterator, num_batches, device)
+        if self._ignore_data_skip is not None:
+            self.args.ignore_data_skip, self._ignore_data_skip = self._ignore_data_skip, None
+        sampler = self._resumable_sampler()
+        if sampler is not None:
+            # Every process takes one batch of the sampler's indices per dataloader batch
+            sampler.advance(len(batch_samples) * self._train_batch_size * self.args.steps_per_generation * self.args.world_size)
+        return batch_samples, num_items_in_batch
+
+    def _dedup_checkpoint_files(self, checkpoint_dir, previous_dir, final_dir):
+        # Digests are remembered per directory so the previous checkpoint is not hashed again
+        previous_digests = self._checkpoint_digests[1] if self._checkpoint_digests[0] == previous_dir else {}
+        digests, saved = link_unchanged_checkpoint_files(checkpoint_dir, previous_dir, previous_digests)
+        self._checkpoint_digests = (final_dir, digests)
+        return saved
+
+    def wait_for_checkpoint(self):
+        """
+        Block until the checkpoint being written in the background is on disk, re-raising any write error. Returns the
+        bytes saved by deduplicating it, or None.
+        """
+        future, self._checkpoint_future = self._checkpoint_future, None
+        return None if future is None else future.result()
 
     def create_model_card(
         self,
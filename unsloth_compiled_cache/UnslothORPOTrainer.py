@@ -27,7 +27,7 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 from typing import Any, List, Optional, Tuple, Union, Dict, Set, Callable
-from trl.trainer.orpo_trainer import (Any, AutoModelForCausalLM, BaseImageProcessor, Callable, DPODataCollatorWithPadding, DataCollator, DataLoader, Dataset, EvalLoopOutput, F, FeatureExtractionMixin, Literal, ORPOConfig, ORPOTrainer, Optional, PartialState, Path, PeftModel, PreTrainedModel, PreTrainedTokenizerBase, ProcessorMixin, Trainer, TrainerCallback, Union, add_bos_token_if_needed, add_eos_token_if_needed, autocast, defaultdict, disable_dropout_in_model, generate_model_card, get_comet_experiment_url, inspect, is_comet_available, is_peft_available, is_torch_fx_proxy, is_torch_xla_available, is_wandb_available, log_table_to_comet_experiment, logger, logging, maybe_apply_chat_template, maybe_extract_prompt, nn, np, nullcontext, os, pad_to_length, pd, peft_module_casting_to_bf16, prepare_model_for_kbit_training, random, selective_log_softmax, textwrap, torch, F, Optional, PeftModel, PreTrainedModel, Trainer, is_peft_available, logger, os, torch)
+from trl.trainer.orpo_trainer import (Any, AutoModelForCausalLM, BaseImageProcessor, Callable, DPODataCollatorWithPadding, DataCollator, DataLoader, Dataset, EvalLoopOutput, F, FeatureExtractionMixin, Literal, ORPOConfig, ORPOTrainer, Optional, PartialState, Path, PeftModel, PreTrainedModel, PreTrainedTokenizerBase, ProcessorMixin, Trainer, TrainerCallback, Union, add_bos_token_if_needed, add_eos_token_if_needed, autocast, defaultdict, disable_dropout_in_model, generate_model_card, get_comet_experiment_url, inspect, is_comet_available, is_peft_available, is_torch_fx_proxy, is_torch_xla_available, is_wandb_available, log_table_to_comet_experiment, logger, logging, maybe_apply_chat_template, maybe_extract_prompt, nn, np, nullcontext, os, pad_to_length, pd, peft_module_casting_to_bf16, prepare_model_for_kbit_training, random, textwrap, torch, F, Optional, PeftModel, PreTrainedModel, Trainer, is_peft_available, logger, os, torch)
 
 
 import os
@@ -66,22 +66,34 @@ torch_compile_options = {
     "triton.cudagraphs" : False,
 }
 
+# Upper bound on the float32 logits of one chunk in chunked_selective_log_softmax.
+# The chunk count follows from this and the vocab size instead of being fixed.
+SELECTIVE_LOG_SOFTMAX_CHUNK_BYTES = int(os.environ.get("UNSLOTH_LOG_SOFTMAX_CHUNK_MB", "256")) * 1024 * 1024
+
 @torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def chunked_selective_log_softmax(logits, index):
-    # Split into 4 chunks only
-    chunked_logits = torch.chunk(logits.reshape(-1, logits.shape[-1]), chunks = 4, dim = 0)
-    chunked_index  = torch.chunk(index.reshape(-1), chunks = 4, dim = 0)
+def selective_log_softmax_chunk(chunk_logits, chunk_index):
+    # Gather in the input dtype and only upcast the selected values. The float32 cast
+    # below is fused into the logsumexp reduction, so no float32 copy of the chunk is made.
+    selected_logits = torch.gather(chunk_logits, dim = -1, index = chunk_index.unsqueeze(-1)).squeeze(-1)
+    logsumexp_values = torch.logsumexp(chunk_logits.to(torch.float32), dim = -1)
+    return selected_logits.to(torch.float32) - logsumexp_values
+
+def chunked_selective_log_softmax(logits, index, max_chunk_bytes = None):
+    # Same as selective_log_softmax(logits, index), over row chunks whose float32
+    # logits fit in max_chunk_bytes (SELECTIVE_LOG_SOFTMAX_CHUNK_BYTES by default)
+    if max_chunk_bytes is None: max_chunk_bytes = SELECTIVE_LOG_SOFTMAX_CHUNK_BYTES
+    vocab_size = logits.shape[-1]
+    rows_per_chunk = max(1, max_chunk_bytes // (vocab_size * 4))
+    # Round down to a power of two so chunk shapes repeat across calls
+    rows_per_chunk = 1 << (rows_per_chunk.bit_length() - 1)
+    chunked_logits = torch.split(logits.reshape(-1, vocab_size), rows_per_chunk, dim = 0)
+    chunked_index  = torch.split(index.reshape(-1), rows_per_chunk, dim = 0)
     all_per_token_logps = []
-    # Below loop does the same as selective_log_softmax(chunk_logits, chunk_index)
     for chunk_logits, chunk_index in zip(chunked_logits, chunked_index):
-        chunk_logits = chunk_logits.to(torch.float32)
-        selected_logits = torch.gather(chunk_logits, dim = -1, index = chunk_index.unsqueeze(-1)).squeeze(-1)
-        logsumexp_values = torch.logsumexp(chunk_logits, dim = -1)
-        per_token_logps = selected_logits - logsumexp_values
-        all_per_token_logps.append(per_token_logps)
+        all_per_token_logps.append(selective_log_softmax_chunk(chunk_logits, chunk_index))
     pass
     all_per_token_logps = torch.concat(all_per_token_logps)
-    all_per_token_logps = all_per_token_logps.reshape((logits.shape[0], logits.shape[1]))
+    all_per_token_logps = all_per_token_logps.reshape(index.shape)
     return all_per_token_logps
 
 def calculate_pad_tokens_in_prompt(
@@ -1087,7 +1099,7 @@ class _UnslothORPOTrainer(Trainer):
         # dummy token; we'll ignore the losses on these tokens later
         labels = torch.where(labels == label_pad_token_id, 0, labels)
 
-        per_token_logps = selective_log_softmax(logits, labels)
+        per_token_logps = chunked_selective_log_softmax(logits, labels)
 
         if average_log_prob:
             return (per_token_logps * loss_mask).sum(-1) / loss_mask.sum(-1)
@@ -31,6 +31,13 @@ from trl.trainer.sft_trainer import (Any, AutoConfig, AutoProcessor, Callable, D
 
 
 import os
+import concurrent.futures
+import copy
+import hashlib
+import json
+import re
+import shutil
+import time
 from typing import *
 from dataclasses import dataclass, field
 from packaging.version import Version
@@ -40,6 +47,9 @@ from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling as TransformersDataCollatorForLanguageModeling
 from transformers.training_args import ParallelMode
+from transformers.trainer import OPTIMIZER_NAME, SCALER_NAME, SCHEDULER_NAME, TRAINER_STATE_NAME, TRAINING_ARGS_NAME
+from transformers.trainer_callback import ExportableState
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
 
 # Wrap trainer with padding to right and enable training mode
 import functools
@@ -139,6 +149,104 @@ def left_pack_padding(tensor: torch.Tensor, pad_id: int) -> torch.Tensor:
     sorted_indices = torch.argsort(mask, dim=1, descending=True, stable=True)
     packed_tensor = torch.gather(tensor, 1, sorted_indices)
     return packed_tensor
+
+# Position of a resumable train sampler (one with state_dict/load_state_dict/advance)
+SAMPLER_STATE_NAME = "sampler_state.json"
+
+# Checkpoint files rewritten on every save. The rest (tokenizer, configs, training arguments) rarely change and are
+# shared between checkpoints through hard links when `dedup_checkpoint_files` is set.
+CHECKPOINT_STATE_FILES = (TRAINER_STATE_NAME, OPTIMIZER_NAME, SCHEDULER_NAME, SCALER_NAME, SAMPLER_STATE_NAME)
+
+def is_static_checkpoint_file(name):
+    if name == TRAINING_ARGS_NAME: return True
+    return name not in CHECKPOINT_STATE_FILES and not name.endswith((".safetensors", ".bin", ".pt", ".pth"))
+
+def file_digest(path, chunk_size = 1 << 20):
+    digest = hashlib.blake2b(digest_size = 16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def previous_checkpoint_dir(run_dir, step):
+    """The newest `checkpoint-<n>` directory in `run_dir` with n < step, or None"""
+    pattern = re.compile(rf"{PREFIX_CHECKPOINT_DIR}-(\d+)")
+    steps = [
+        int(match.group(1)) for match in map(pattern.fullmatch, os.listdir(run_dir) if os.path.isdir(run_dir) else [])
+        if match is not None and int(match.group(1)) < step
+    ]
+    return os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{max(steps)}") if steps else None
+
+def link_checkpoint_files(source_dir, target_dir, names):
+    """
+    Hard link `names` from `source_dir` into `target_dir`. Returns False, leaving
+    no partial links behind, if any file is missing or cannot be linked.
+    """
+    if source_dir is None or not names: return False
+    linked = []
+    try:
+        for name in names:
+            os.link(os.path.join(source_dir, name), os.path.join(target_dir, name))
+            linked.append(name)
+    except OSError:
+        # Links share the inode, so a later save must never write through a leftover one
+        for name in linked: os.remove(os.path.join(target_dir, name))
+        return False
+    return True
+
+def link_unchanged_checkpoint_files(checkpoint_dir, previous_dir, previous_digests):
+    """
+    Replace every static file of `checkpoint_dir` that is identical to the same
+    file in `previous_dir` by a hard link to it. `previous_digests` caches the
+    digests of `previous_dir`; the digests of `checkpoint_dir` are returned for
+    the next call. Returns (digests, bytes saved).
+    """
+    digests, saved = {}, 0
+    for name in sorted(os.listdir(checkpoint_dir)):
+        path = os.path.join(checkpoint_dir, name)
+        if not os.path.isfile(path) or not is_static_checkpoint_file(name): continue
+        digests[name] = file_digest(path)
+        previous_path = None if previous_dir is None else os.path.join(previous_dir, name)
+        if previous_path is None or not os.path.isfile(previous_path): continue
+        if os.path.samefile(path, previous_path): continue
+        if (previous_digests.get(name) or file_digest(previous_path)) != digests[name]: continue
+        link_path = f"{path}.link"
+        try:
+            os.link(previous_path, link_path)
+        except OSError:
+            continue  # e.g. a filesystem without hard links
+        saved += os.path.getsize(path)
+        os.replace(link_path, path)
+    return digests, saved
+
+def snapshot_to_cpu(obj, buffers, path = ()):
+    """
+    Copy every tensor of a (nested) state dict to CPU memory. Buffers from the
+    previous checkpoint are reused when the shape and dtype match, and copies
+    from the GPU go to pinned memory without blocking, so the caller must
+    synchronize once after the whole snapshot is taken.
+    """
+    if isinstance(obj, torch.Tensor):
+        buffer = buffers.get(path)
+        if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+            buffer = torch.empty(obj.shape, dtype = obj.dtype, device = "cpu", pin_memory = obj.is_cuda)
+            buffers[path] = buffer
+        buffer.copy_(obj.detach(), non_blocking = obj.is_cuda)
+        return buffer
+    if isinstance(obj, dict):
+        return {key: snapshot_to_cpu(value, buffers, path + (key,)) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)([snapshot_to_cpu(value, buffers, path + (i,)) for i, value in enumerate(obj)])
+    return copy.deepcopy(obj)
+
+class AsyncCheckpointCallback(TrainerCallback):
+    """Waits for the last background checkpoint write when training ends"""
+    def __init__(self, trainer):
+        self.trainer = trainer
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.trainer.wait_for_checkpoint()
+
 @dataclass
 class UnslothSFTConfig(SFTConfig):
     """
@@ -228,6 +336,14 @@ class UnslothSFTConfig(SFTConfig):
         default = None,
         metadata = {'help': 'Maximum sequence length to truncate to.'},
     )
+    async_checkpointing : Optional[bool] = field(
+        default = False,
+        metadata = {'help': 'Snapshot checkpoints to pinned CPU memory and write them on a background thread, renaming them into place when complete. Single process only.'},
+    )
+    dedup_checkpoint_files : Optional[bool] = field(
+        default = False,
+        metadata = {'help': 'Hard link the tokenizer, configs and training arguments of a checkpoint to the previous checkpoint when unchanged, instead of storing another copy.'},
+    )
     def __init__(
         self,
         output_dir = None,
@@ -378,6 +494,8 @@ class UnslothSFTConfig(SFTConfig):
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
         max_seq_length = None,
+        async_checkpointing = False,
+        dedup_checkpoint_files = False,
         **kwargs,
     ):
         if learning_rate < 1e-7: print(f'Unsloth: Your learning rate of `{learning_rate}` is too small and less than 1e-7! Consider increasing it, otherwise gradient updates will be close to 0!')
@@ -544,6 +662,8 @@ class UnslothSFTConfig(SFTConfig):
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
         self.max_seq_length = max_seq_length
+        self.async_checkpointing = async_checkpointing
+        self.dedup_checkpoint_files = dedup_checkpoint_files
 pass
 
 class _UnslothSFTTrainer(Trainer):
@@ -840,6 +960,17 @@ class _UnslothSFTTrainer(Trainer):
         # Add tags for models that have been loaded with the correct transformers version
         if hasattr(self.model, "add_model_tags"):
             self.model.add_model_tags(self._tag_names)
+        # Background checkpoint writer, see _save_checkpoint_async
+        self._checkpoint_writer = None
+        self._checkpoint_future = None
+        self._checkpoint_buffers = {}
+        # (checkpoint directory, {file: digest}) of the last deduplicated checkpoint, see _dedup_checkpoint_files
+        self._checkpoint_digests = (None, {})
+        self._processing_class_files = []
+        # args.ignore_data_skip to restore after resuming with a saved sampler position
+        self._ignore_data_skip = None
+        if getattr(args, "async_checkpointing", False):
+            self.add_callback(AsyncCheckpointCallback(self))
 
     def _prepare_dataset(
         self,
@@ -1028,7 +1159,173 @@ class _UnslothSFTTrainer(Trainer):
         else:
             model_name = self.args.hub_model_id.split("/")[-1]
         self.create_model_card(model_name=model_name)
+        if self._use_async_checkpointing():
+            self._save_checkpoint_async(model, trial)
+            return
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+        dedup = getattr(self.args, "dedup_checkpoint_files", False) and self.args.should_save
+        if dedup and os.path.isdir(output_dir):
+            # Its files may be hard links into an older checkpoint, which the save below would write through
+            shutil.rmtree(output_dir)
+        previous_dir = previous_checkpoint_dir(run_dir, self.state.global_step) if dedup else None
         super()._save_checkpoint(model, trial)
+        if self.args.should_save:
+            self._save_sampler_state(output_dir)
+        if dedup:
+            saved = self._dedup_checkpoint_files(output_dir, previous_dir, output_dir)
+            self._metrics["train"]["checkpoint/dedup_bytes"].append(saved)
+
+    def _use_async_checkpointing(self):
+        # Sharded and multi-process saves, Hub pushes and best model tracking keep the synchronous path
+        args = self.args
+        return (
+            getattr(args, "async_checkpointing", False)
+            and args.world_size == 1
+            and not self.is_deepspeed_enabled
+            and not self.is_fsdp_enabled
+            and not args.push_to_hub
+            and args.metric_for_best_model is None
+            and hasattr(self.accelerator.unwrap_model(self.model), "save_pretrained")
+        )
+
+    def _save_checkpoint_async(self, model, trial):
+        """
+        Copies the weights and optimizer state to pinned CPU buffers and writes the checkpoint on a background thread,
+        so training continues as soon as the device-to-host copies finish. Files go to a hidden staging directory
+        that is renamed to `checkpoint-<step>` once complete, and older checkpoints are only rotated out after that,
+        so a crash mid-write never leaves a partial checkpoint behind.
+        """
+        start = time.perf_counter()
+        # The previous write still reads the pinned buffers this snapshot reuses
+        saved = self.wait_for_checkpoint()
+        if saved is not None:
+            # Metrics are only touched from the training thread
+            self._metrics["train"]["checkpoint/dedup_bytes"].append(saved)
+
+        checkpoint_folder = f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}"
+        if self.hp_search_backend is None and trial is None:
+            self.store_flos()
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, checkpoint_folder)
+        staging_dir = os.path.join(run_dir, f".{checkpoint_folder}.tmp")
+        if os.path.isdir(staging_dir):
+            shutil.rmtree(staging_dir)
+        os.makedirs(staging_dir)
+
+        unwrapped_model = self.accelerator.unwrap_model(model)
+        if hasattr(unwrapped_model, "peft_config"):
+            # PEFT only saves the adapter, so only the trainable parameters need copying
+            model_state = {name: param for name, param in unwrapped_model.named_parameters() if param.requires_grad}
+        else:
+            model_state = unwrapped_model.state_dict()
+        buffers = self._checkpoint_buffers
+        model_state = snapshot_to_cpu(model_state, buffers, ("model",))
+        optimizer_state = scheduler_state = scaler_state = None
+        if not self.args.save_only_model:
+            optimizer_state = snapshot_to_cpu(self.optimizer.state_dict(), buffers, ("optimizer",))
+            scheduler_state = copy.deepcopy(self.lr_scheduler.state_dict())
+            if self.accelerator.scaler is not None:
+                scaler_state = copy.deepcopy(self.accelerator.scaler.state_dict())
+            self._save_rng_state(staging_dir)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        # Small files are written now so they match this step exactly
+        for cb in [cb for cb in self.callback_handler.callbacks + [self.control] if isinstance(cb, ExportableState)]:
+            cb_name = cb.__class__.__name__
+            cb_state = cb.state()
+            if isinstance(self.state.stateful_callbacks[cb_name], list):
+                self.state.stateful_callbacks[cb_name].append(cb_state)
+            else:
+                self.state.stateful_callbacks[cb_name] = cb_state
+        self.state.save_to_json(os.path.join(staging_dir, TRAINER_STATE_NAME))
+        torch.save(self.args, os.path.join(staging_dir, TRAINING_ARGS_NAME))
+        self._save_sampler_state(staging_dir)
+        dedup = getattr(self.args, "dedup_checkpoint_files", False)
+        previous_dir = previous_checkpoint_dir(run_dir, self.state.global_step) if dedup else None
+
+        def write_checkpoint():
+            unwrapped_model.save_pretrained(
+                staging_dir, state_dict=model_state, safe_serialization=self.args.save_safetensors
+            )
+            # The tokenizer does not change during training, so after the first save its files are linked instead
+            if self.processing_class is not None and not (
+                dedup and link_checkpoint_files(previous_dir, staging_dir, self._processing_class_files)
+            ):
+                existing = set(os.listdir(staging_dir))
+                self.processing_class.save_pretrained(staging_dir)
+                self._processing_class_files = sorted(set(os.listdir(staging_dir)) - existing)
+            if optimizer_state is not None:
+                torch.save(optimizer_state, os.path.join(staging_dir, OPTIMIZER_NAME))
+                torch.save(scheduler_state, os.path.join(staging_dir, SCHEDULER_NAME))
+            if scaler_state is not None:
+                torch.save(scaler_state, os.path.join(staging_dir, SCALER_NAME))
+            saved = self._dedup_checkpoint_files(staging_dir, previous_dir, output_dir) if dedup else None
+            if os.path.isdir(output_dir):
+                shutil.rmtree(output_dir)
+            os.replace(staging_dir, output_dir)
+            self._rotate_checkpoints(use_mtime=False, output_dir=run_dir)
+            return saved
+
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="checkpoint"
+            )
+        self._checkpoint_future = self._checkpoint_writer.submit(write_checkpoint)
+        self._metrics["train"]["checkpoint/save_stall_seconds"].append(time.perf_counter() - start)
+
+    def _resumable_sampler(self):
+        # Set by training_data.install_train_sampler; the default samplers keep the Trainer's batch skipping
+        sampler = getattr(self, "train_sampler", None)
+        return sampler if hasattr(sampler, "load_state_dict") else None
+
+    def _save_sampler_state(self, output_dir):
+        sampler = self._resumable_sampler()
+        if sampler is None:
+            return
+        with open(os.path.join(output_dir, SAMPLER_STATE_NAME), "w") as file:
+            json.dump(sampler.state_dict(), file)
+
+    def _load_from_checkpoint(self, resume_from_checkpoint, model=None):
+        super()._load_from_checkpoint(resume_from_checkpoint, model)
+        sampler = self._resumable_sampler()
+        state_path = os.path.join(resume_from_checkpoint, SAMPLER_STATE_NAME)
+        if sampler is None or not os.path.isfile(state_path):
+            return
+        with open(state_path) as file:
+            sampler.load_state_dict(json.load(file))
+        # The sampler seeks to the saved position itself, so the Trainer must not replay batches to get there. The
+        # flag is read once when the training loop starts and restored on the first batch. With a delayed optimizer
+        # (FSDP/DeepSpeed) this runs twice before that, so only the user's value is stashed, never the forced True.
+        if self._ignore_data_skip is None:
+            self._ignore_data_skip = self.args.ignore_data_skip
+        self.args.ignore_data_skip = True
+
+    def get_batch_samples(self, epoch_iterator, num_batches, device):
+        batch_samples, num_items_in_batch = super().get_batch_samples(epoch_iterator, num_batches, device)
+        if self._ignore_data_skip is not None:
+            self.args.ignore_data_skip, self._ignore_data_skip = self._ignore_data_skip, None
+        sampler = self._resumable_sampler()
+        if sampler is not None:
+            # Every process takes one batch of the sampler's indices per dataloader batch
+            sampler.advance(len(batch_samples) * self._train_batch_size * self.args.world_size)
+        return batch_samples, num_items_in_batch
+
+    def _dedup_checkpoint_files(self, checkpoint_dir, previous_dir, final_dir):
+        # Digests are remembered per directory so the previous checkpoint is not hashed again
+        previous_digests = self._checkpoint_digests[1] if self._checkpoint_digests[0] == previous_dir else {}
+        digests, saved = link_unchanged_checkpoint_files(checkpoint_dir, previous_dir, previous_digests)
+        self._checkpoint_digests = (final_dir, digests)
+        return saved
+
+    def wait_for_checkpoint(self):
+        """
+        Block until the checkpoint being written in the background is on disk, re-raising any write error. Returns the
+        bytes saved by deduplicating it, or None.
+        """
+        future, self._checkpoint_future = self._checkpoint_future, None
+        return None if future is None else future.result()
 
     def create_model_card(
         self,